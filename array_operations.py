@@ -0,0 +1,546 @@
+from __future__ import division
+import logging
+from math import ceil, exp, sqrt, pi
+from multiprocessing.pool import ThreadPool
+from os import path
+from shutil import copy
+import threading
+
+import numpy as np
+from PIL import Image
+
+try:
+    from scipy.ndimage import correlate1d
+except ImportError:
+    correlate1d = None
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+from file_operations import get_files_by_extension
+from lut_operations import lut_for, apply_lut
+from tile_operations import (
+    tiles_per_row, tile_count, tile_filename, tile_index, tile_box, fit_size, tile_outputs)
+
+# ImageMagick is assumed to be a Q16 build, so every threshold, blur and
+# composite below is computed against a 16-bit quantum
+QUANTUM_RANGE = 65535
+
+VISUALIZATION_SIZE = 1000
+
+# the "-draw" fills of image_operations.draw_visualization, by tile class:
+# none, land, clouds, water
+CLASS_COLORS = np.array([[0, 0, 0], [0, 255, 0], [255, 255, 255], [0, 0, 255]], dtype=np.float64)
+CLASS_ALPHA = np.array([0.0, 0.5, 0.5, 0.5])
+
+def get_dimensions(a_file):
+    # opening an image only reads its header
+    return list(Image.open(a_file).size)
+
+def get_height(a_file):
+    return get_dimensions(a_file)[1]
+
+def get_width(a_file):
+    return get_dimensions(a_file)[0]
+
+LOCK = threading.Lock()
+FILE_LOCKS = {}
+
+def _arrays(config):
+    with LOCK:
+        if not hasattr(config, 'ARRAYS'):
+            config.ARRAYS = {}
+        return config.ARRAYS
+
+def _file_lock(a_file):
+    # concurrent stages share bands, make sure each is only decoded once
+    with LOCK:
+        return FILE_LOCKS.setdefault(a_file, threading.Lock())
+
+def raw_pixels(data):
+    if data.dtype == np.bool_:
+        return data.astype(np.uint8) * 255
+
+    if data.dtype == np.uint8 or data.dtype == np.uint16:
+        return data
+
+    # signed surface reflectance bands are read as their raw 16 bit pattern,
+    # exactly like convert does, so the LUTs see -9999 as 55537
+    return (data.astype(np.int64) & 0xFFFF).astype(np.uint16)
+
+def read_image(a_file):
+    return raw_pixels(np.asarray(Image.open(a_file)))
+
+def open_band(a_file):
+    # uncompressed GeoTIFFs are mapped so a strip only pages in its own rows
+    if tifffile is not None:
+        try:
+            return tifffile.memmap(a_file, mode='r')
+        except ValueError:
+            pass
+
+    logging.getLogger("ff-import").warning(
+        "Reading all of %s, install tifffile to map it instead", path.basename(a_file))
+    return np.asarray(Image.open(a_file))
+
+def write_image(data, a_file):
+    Image.fromarray(data).save(a_file)
+
+def scratch_file(a_file, config):
+    # npy scratch keeps shape and dtype in a small header and maps zero-copy
+    if config.SCRATCH_FORMAT != "npy" or \
+            path.dirname(path.abspath(a_file)) != path.abspath(config.SCRATCH_PATH):
+        return a_file
+    return path.splitext(a_file)[0] + ".npy"
+
+def load(a_file, config):
+    arrays = _arrays(config)
+    with _file_lock(a_file):
+        if a_file not in arrays:
+            source = scratch_file(a_file, config)
+            if source != a_file and path.exists(source):
+                arrays[a_file] = np.load(source, mmap_mode='r')
+            else:
+                arrays[a_file] = read_image(a_file)
+    return arrays[a_file]
+
+def store(data, a_file, config):
+    _arrays(config)[a_file] = data
+    target = scratch_file(a_file, config)
+    if target == a_file:
+        write_image(data, a_file)
+    else:
+        np.save(target, data)
+
+def to_quantum(data):
+    if data.dtype == np.uint8:
+        return data.astype(np.int32) * 257
+    return data.astype(np.int32)
+
+def to_depth8(data):
+    return ((to_quantum(data) + 128) // 257).astype(np.uint8)
+
+def to_depth16(data):
+    return np.clip(to_quantum(data), 0, QUANTUM_RANGE).astype(np.uint16)
+
+def parse_blur(geometry):
+    [radius, sigma] = [float(elem) for elem in geometry.split("x")]
+    return [radius, sigma]
+
+def blur_kernel(radius, sigma):
+    # mirrors GetOptimalKernelWidth1D so "0xS" picks the same width as convert
+    if radius > 0:
+        width = int(2 * ceil(radius) + 1)
+    else:
+        alpha = 1.0 / (2.0 * sigma * sigma)
+        beta = 1.0 / (sqrt(2.0 * pi) * sigma)
+        width = 5
+        while True:
+            half = (width - 1) // 2
+            normalize = sum(exp(-(i * i) * alpha) * beta for i in range(-half, half + 1))
+            value = exp(-(half * half) * alpha) * beta / normalize
+            if value < 1.0 / QUANTUM_RANGE:
+                break
+            width += 2
+        width -= 2
+
+    half = (width - 1) // 2
+    offsets = np.arange(-half, half + 1, dtype=np.float64)
+    kernel = np.exp(-(offsets * offsets) / (2.0 * sigma * sigma))
+    return kernel / kernel.sum()
+
+def _convolve_rows(data, kernel):
+    if correlate1d is not None:
+        result = correlate1d(data, kernel, axis=1, mode='nearest')
+        return np.floor(np.clip(result, 0, QUANTUM_RANGE) + 0.5)
+
+    half = len(kernel) // 2
+    padded = np.pad(data, ((0, 0), (half, half)), mode='edge')
+    result = np.zeros(data.shape, dtype=np.float64)
+    columns = data.shape[1]
+    for offset, weight in enumerate(kernel):
+        result += weight * padded[:, offset:offset + columns]
+    return np.floor(np.clip(result, 0, QUANTUM_RANGE) + 0.5)
+
+def blur(data, geometry):
+    [radius, sigma] = parse_blur(geometry)
+    kernel = blur_kernel(radius, sigma)
+
+    # convert applies the 1D kernel horizontally then vertically, clamping to
+    # the quantum in between, with edge virtual pixels
+    result = _convolve_rows(to_quantum(data).astype(np.float64), kernel)
+    result = _convolve_rows(result.T, kernel).T
+    return result.astype(np.uint16)
+
+def threshold(data, level):
+    return np.where(to_quantum(data) > level, QUANTUM_RANGE, 0).astype(np.uint16)
+
+def white_threshold(data, level):
+    quantum = to_quantum(data)
+    return np.where(quantum > level, QUANTUM_RANGE, quantum).astype(np.uint16)
+
+def compose_add(destination, source):
+    return to_depth16(to_quantum(destination) + to_quantum(source))
+
+def compose_minus(destination, source):
+    # removes the source (snow) from the destination, as "-compose minus_src"
+    return to_depth16(to_quantum(destination) - to_quantum(source))
+
+def compose_darken(destination, source):
+    return np.minimum(to_quantum(destination), to_quantum(source))
+
+def compose_lighten(destination, source):
+    return np.maximum(to_quantum(destination), to_quantum(source))
+
+def brightness(data, percent):
+    quantum = to_quantum(data) + percent / 100.0 * QUANTUM_RANGE
+    return to_depth8(np.floor(np.clip(quantum, 0, QUANTUM_RANGE) + 0.5).astype(np.int32))
+
+def crop_tiles(data, grid_size):
+    height, width = data.shape[:2]
+    for top in range(0, height, grid_size):
+        for left in range(0, width, grid_size):
+            yield data[top:top + grid_size, left:left + grid_size]
+
+def encode_tile(tile, a_file, size, compression):
+    image = Image.fromarray(tile)
+    if size:
+        image = image.resize(fit_size(image.size[0], image.size[1], size), Image.LANCZOS)
+    image.save(a_file, compress_level=compression)
+
+def encode_tiles(tiles, config):
+    # [view, file, size] for every tile
+    def encode(job):
+        encode_tile(job[0], job[1], job[2], config.PNG_COMPRESSION)
+
+    if config.TILE_WORKERS > 1 and len(tiles) > 1:
+        pool = ThreadPool(config.TILE_WORKERS)
+        try:
+            pool.map(encode, tiles)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for job in tiles:
+            encode(job)
+
+def write_tiles(data, grid_size, target, config, first_index=0, size=0):
+    encode_tiles([
+        [tile, target % (first_index + idx), size]
+        for idx, tile in enumerate(crop_tiles(data, grid_size))], config)
+
+def mask_band(qa, which_lut, config):
+    return apply_lut(lut_for(which_lut, config), qa)
+
+def land_source(water, cloud, snow):
+    return compose_minus(compose_add(water, cloud), snow)
+
+def clamp_band(band, snow, config, boost, brighten):
+    lut = ("clamp_lut.pgm" if boost else "boost_lut.pgm")
+
+    # convert's "-colors 256" picks 256 levels adaptively when the channel has
+    # more, to_depth8 rounds every level uniformly instead, so the two engines
+    # differ here, compare_engines.py measures by how much
+    channel = to_depth8(apply_lut(lut_for(lut, config), band))
+    channel = to_depth8(compose_lighten(channel, snow))
+
+    if brighten:
+        channel = brightness(channel, 10)
+
+    return channel
+
+def water_masks(water_mask):
+    water = blur(water_mask, "5x2")
+    water = white_threshold(water, 254)
+    water = blur(water, "20x2")
+    water = threshold(water, 254)
+
+    land = (QUANTUM_RANGE - water).astype(np.uint16)
+    return [water, land]
+
+def mask_boost(boost, water):
+    return to_depth8(compose_darken(boost, water))
+
+def final_green(green, land, masked):
+    green = to_depth8(compose_darken(green, land))
+    return to_depth8(np.clip(to_quantum(green) + to_quantum(masked), 0, QUANTUM_RANGE))
+
+def combine(red, green, blue):
+    return np.dstack([to_depth8(red), green, to_depth8(blue)])
+
+def tile_statistics(mask, grid_size, first_index=0):
+    height, width = mask.shape[:2]
+    starts = np.arange(0, width, grid_size)
+    widths = np.diff(np.append(starts, width))
+    per_row = tiles_per_row(width, grid_size)
+    table = {}
+
+    # one grid row at a time, reduceat keeps the clipped last column exact
+    for row, top in enumerate(range(0, height, grid_size)):
+        band = to_quantum(mask[top:top + grid_size]) / QUANTUM_RANGE
+        count = band.shape[0] * widths
+
+        minima = np.minimum.reduceat(band.min(axis=0), starts)
+        maxima = np.maximum.reduceat(band.max(axis=0), starts)
+        mean = np.add.reduceat(band.sum(axis=0), starts) / count
+        square = np.add.reduceat((band * band).sum(axis=0), starts) / count
+        deviation = np.sqrt(np.maximum(square - mean * mean, 0))
+
+        for col in range(per_row):
+            table[first_index + row * per_row + col] = [
+                100 * minima[col],
+                100 * maxima[col],
+                100 * mean[col],
+                100 * deviation[col]]
+
+    return table
+
+def _tile_statistics(config):
+    if not hasattr(config, 'TILE_STATISTICS'):
+        config.TILE_STATISTICS = {}
+    return config.TILE_STATISTICS
+
+def _blurred_masks(config):
+    if not hasattr(config, 'BLURRED_MASKS'):
+        config.BLURRED_MASKS = {}
+    return config.BLURRED_MASKS
+
+def blurred_mask(config, subdirectory):
+    masks = _blurred_masks(config)
+    if subdirectory not in masks:
+        if subdirectory == "land":
+            masks[subdirectory] = build_land_mask(config)
+        else:
+            masks[subdirectory] = build_cloud_mask(config)
+    return masks[subdirectory]
+
+def get_tile_statistics(config, subdirectory, filenames):
+    statistics = _tile_statistics(config)
+    if subdirectory not in statistics:
+        statistics[subdirectory] = tile_statistics(
+            blurred_mask(config, subdirectory), config.GRID_SIZE)
+    return statistics[subdirectory]
+
+def build_mask_files(config, which_lut, which_mask):
+    source = load(config.NEW_MASK, config)
+    store(mask_band(source, which_lut, config), which_mask, config)
+
+def build_land_mask(config):
+    combined = land_source(
+        load(config.WATER_MASK, config),
+        load(config.CLOUD_MASK, config),
+        load(config.SNOW_MASK, config))
+    return blur(combined, config.MASK_BLUR)
+
+def build_cloud_mask(config):
+    return blur(load(config.CLOUD_MASK, config), config.MASK_BLUR)
+
+def get_mask_tiles(config):
+    if not config.VIRTUAL_TILES:
+        return get_files_by_extension(path.join(config.SCRATCH_PATH, "land"), "png")
+
+    count = tile_count(config.width, config.height, config.GRID_SIZE)
+    return [tile_filename(idx) for idx in range(count)]
+
+def _prepare_mask(config, subdirectory):
+    mask = blurred_mask(config, subdirectory)
+
+    # virtual tiles are only ever addressed by index into the blurred mask
+    if config.VIRTUAL_TILES:
+        return
+
+    write_tiles(
+        mask,
+        config.GRID_SIZE,
+        path.join(config.SCRATCH_PATH, subdirectory, "tile_%04d.png"),
+        config)
+
+def prepare_land_mask(config):
+    _prepare_mask(config, "land")
+
+def prepare_cloud_mask(config):
+    _prepare_mask(config, "cloud")
+
+def clamp_image(source, dest, config, brighten):
+    logger = logging.getLogger(config.SCENE_NAME)
+    logger.info("Clamping file %s", path.basename(source))
+    target = path.join(config.SCRATCH_PATH, dest  + ".png")
+    _clamp_image(source, target, config, False, brighten)
+
+def boost_image(source, config):
+    logger = logging.getLogger(config.SCENE_NAME)
+    logger.info("Boosting file %s", path.basename(source))
+    _clamp_image(source, path.join(config.SCRATCH_PATH, "boost.png"), config, True, False)
+
+def _clamp_image(source, dest, config, boost, brighten):
+    channel = clamp_band(
+        load(source, config),
+        load(path.join(config.SCRATCH_PATH, "snow_mask.png"), config),
+        config, boost, brighten)
+    store(channel, dest, config)
+
+def assemble_image(config):
+    logger = logging.getLogger(config.SCENE_NAME)
+
+    logger.info("Generating simplified land/water masks")
+    [water, land] = water_masks(load(config.WATER_MASK, config))
+    store(water, path.join(config.SCRATCH_PATH, "water.png"), config)
+    store(land, path.join(config.SCRATCH_PATH, "land.png"), config)
+
+    logger.info("Masking boosted green channel")
+    masked = mask_boost(load(config.INFRARED_CHANNEL, config), water)
+    store(masked, path.join(config.SCRATCH_PATH, "masked.png"), config)
+
+    logger.info("Building final green channel")
+    green = final_green(load(config.GREEN_CHANNEL, config), land, masked)
+    store(green, path.join(config.SCRATCH_PATH, "green_final.png"), config)
+
+    logger.info("Compositing red, green, and blue images")
+    render = combine(
+        load(config.RED_CHANNEL, config),
+        green,
+        load(config.BLUE_CHANNEL, config))
+    store(render, path.join(config.SCRATCH_PATH, "render.png"), config)
+    publish_render(config)
+
+def publish_render(config):
+    render = path.join(config.SCRATCH_PATH, "render.png")
+    if config.SCRATCH_FORMAT == "npy":
+        write_image(load(render, config), config.SCENE_NAME + "_tiles/render.png")
+    else:
+        copy(render, config.SCENE_NAME + "_tiles/render.png")
+
+def generate_rectangles(tiles, width, grid_size):
+    # tiles are painted from a class grid, only their indices are needed
+    return [tile_index(tile) for tile in tiles]
+
+def class_grid(land, clouds, water, config):
+    rows = tiles_per_row(config.height, config.GRID_SIZE)
+    per_row = tiles_per_row(config.width, config.GRID_SIZE)
+    grid = np.zeros(rows * per_row, dtype=np.uint8)
+
+    for value, tiles in enumerate([land, clouds, water], 1):
+        grid[np.array(tiles, dtype=np.intp)] = value
+
+    return grid.reshape(rows, per_row)
+
+def draw_visualization(land, clouds, water, config):
+    scene = load(config.INPUT_FILE, config)
+    height, width = scene.shape[:2]
+
+    # only every step-th pixel can show in the preview, so no more are read
+    step = max(1, -(-max(width, height) // VISUALIZATION_SIZE))
+    preview = to_depth8(scene[::step, ::step]).astype(np.float64)
+    if preview.ndim == 2:
+        preview = preview[:, :, np.newaxis]
+
+    classes = class_grid(land, clouds, water, config)[np.ix_(
+        np.arange(0, height, step) // config.GRID_SIZE,
+        np.arange(0, width, step) // config.GRID_SIZE)]
+    alpha = CLASS_ALPHA[classes][:, :, np.newaxis]
+    blended = preview * (1 - alpha) + CLASS_COLORS[classes] * alpha
+
+    Image.fromarray(np.rint(blended).astype(np.uint8)).resize(
+        fit_size(width, height, VISUALIZATION_SIZE), Image.BILINEAR
+    ).save(config.SCENE_NAME + "_tiles/visualize.png")
+
+def prepare_tiles(config):
+    write_tiles(
+        load(path.join(config.SCRATCH_PATH, "render.png"), config),
+        config.GRID_SIZE,
+        path.join(config.SCRATCH_PATH, "scene", "tile_%04d.png"),
+        config,
+        size=config.TILE_SIZE)
+
+def write_sorted_tiles(config, accepted, rejected):
+    render = load(path.join(config.SCRATCH_PATH, "render.png"), config)
+    tiles_dir = "{0}_tiles".format(config.SCENE_NAME)
+    tiles = []
+
+    for [filenames, destination, size] in tile_outputs(config, accepted, rejected):
+        for filename in filenames:
+            [left, top, width, height] = tile_box(
+                tile_index(filename), config.width, config.height, config.GRID_SIZE)
+            tiles.append([
+                render[top:top + height, left:left + width],
+                path.join(tiles_dir, destination, filename),
+                size])
+
+    encode_tiles(tiles, config)
+
+def stream_margin(config):
+    # rows a strip borrows from its neighbours so every blur sees real pixels
+    mask_margin = len(blur_kernel(*parse_blur(config.MASK_BLUR))) // 2
+    water_margin = len(blur_kernel(5, 2)) // 2 + len(blur_kernel(20, 2)) // 2
+    return max(mask_margin, water_margin)
+
+def stream_scene(config):
+    logger = logging.getLogger(config.SCENE_NAME)
+
+    qa = open_band(config.NEW_MASK)
+    red = open_band(config.RED_CHANNEL)
+    infrared = open_band(config.INFRARED_CHANNEL)
+    blue = open_band(config.BLUE_CHANNEL)
+
+    height, width = qa.shape[:2]
+    grid_size = config.GRID_SIZE
+    per_row = tiles_per_row(width, grid_size)
+    strip_height = config.STRIP_TILES * grid_size
+    margin = stream_margin(config)
+
+    statistics = _tile_statistics(config)
+    statistics["land"] = {}
+    statistics["cloud"] = {}
+
+    # the full render is never held, SCENE_tiles/render.png gets every step-th
+    # pixel of each strip, a preview the size of the visualization
+    step = max(1, -(-max(width, height) // VISUALIZATION_SIZE))
+    preview = []
+
+    for top in range(0, height, strip_height):
+        bottom = min(top + strip_height, height)
+        above = max(0, top - margin)
+        below = min(height, bottom + margin)
+        core = slice(top - above, bottom - above)
+        first_index = (top // grid_size) * per_row
+
+        logger.info("Processing rows %d to %d", top, bottom)
+        window = raw_pixels(qa[above:below])
+        water_mask = mask_band(window, "water_lut.pgm", config)
+        cloud_mask = mask_band(window, "cloud_lut.pgm", config)
+        snow_mask = mask_band(window, "snow_lut.pgm", config)
+
+        land = blur(land_source(water_mask, cloud_mask, snow_mask), config.MASK_BLUR)
+        statistics["land"].update(tile_statistics(land[core], grid_size, first_index))
+        cloud = blur(cloud_mask, config.MASK_BLUR)
+        statistics["cloud"].update(tile_statistics(cloud[core], grid_size, first_index))
+
+        if not config.ASSEMBLE_IMAGE and not config.SLICE_IMAGE:
+            continue
+
+        [water_core, land_core] = [mask[core] for mask in water_masks(water_mask)]
+        snow_core = snow_mask[core]
+        infrared_core = raw_pixels(infrared[top:bottom])
+
+        masked = mask_boost(clamp_band(infrared_core, snow_core, config, True, False), water_core)
+        green = final_green(
+            clamp_band(infrared_core, snow_core, config, False, False), land_core, masked)
+        render = combine(
+            clamp_band(raw_pixels(red[top:bottom]), snow_core, config, False, False),
+            green,
+            clamp_band(raw_pixels(blue[top:bottom]), snow_core, config, False, True))
+        preview.append(render[(-top) % step::step, ::step])
+
+        # the strip's tiles are final, write them before reading the next one
+        write_tiles(
+            render,
+            grid_size,
+            path.join(config.SCRATCH_PATH, "scene", "tile_%04d.png"),
+            config,
+            first_index,
+            config.TILE_SIZE)
+
+    if preview:
+        write_image(np.vstack(preview), config.SCENE_NAME + "_tiles/render.png")
@@ -0,0 +1,292 @@
+from os import path, listdir, environ, getpid, kill
+from sys import argv
+from multiprocessing import Pool, Queue
+from time import sleep
+from timeit import default_timer
+import json
+import logging
+import traceback
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+from csv_operations import write_batch_summary
+from file_operations import get_files_by_extension
+from ledger_operations import FINISHED, mark_scene, finished_scenes, scene_id, forget_scene
+from metrics_operations import aggregate_metrics
+from xml_operations import index_metadata
+
+logging.basicConfig(
+    format='[ff-import %(name)s] %(levelname)s %(asctime)-15s %(message)s'
+)
+
+def usage():
+    print("""
+batch.py (Batch Image Pipeline)
+
+python batch.py [--option] SOURCE_DIR [simple.py options]
+
+Runs simple.py over every scene directory in SOURCE_DIR on a pool of worker
+processes. Workers are reused between scenes, a failing scene, or one whose
+worker is killed, is reported and does not stop the batch, and a summary of
+every scene is written at the end. Any option not listed below is passed on
+to simple.py, with --full added unless one of its actions is given.
+
+    --workers=N             Number of scenes processed at once (default 4)
+
+    --summary=MY_FILE       Where to write the per-scene summary
+                            (default batch_summary.csv), with --metrics the
+                            stage totals go next to it in MY_FILE_metrics.json
+
+    --metadata-index=MY_FILE
+                            Where to keep the metadata of every scene, only
+                            scenes whose XML changed are read again
+                            (default metadata_index.json)
+
+    --max-cloud-cover=XX    Skip scenes whose metadata reports more than XX
+                            percent cloud cover
+
+    --ledger=MY_FILE        SQLite ledger recording the state of every scene
+                            and the finished stages of each one
+                            (default batch_ledger.sqlite)
+    --resume                Skip scenes the ledger records as finished whose
+                            SCENE_tiles is still there, and keep every other
+                            scene's scratch directory so a restarted batch
+                            picks up at its first unfinished stage
+    """)
+
+def find_scenes(source_dir):
+    scenes = []
+
+    for name in sorted(listdir(source_dir)):
+        scene_dir = path.join(source_dir, name)
+        if path.isdir(scene_dir) and get_files_by_extension(scene_dir, "xml"):
+            scenes.append(scene_dir)
+
+    return scenes
+
+def plan_scenes(scenes, index, max_cloud_cover):
+    # [scenes to process, scenes skipped] judged from the index alone
+    indexed = dict((entry['scene_dir'], entry['metadata']) for entry in index.values())
+    planned = []
+    skipped = []
+
+    for scene_dir in scenes:
+        metadata = indexed.get(path.abspath(scene_dir))
+        if max_cloud_cover is not None and metadata and metadata.get('!cloud_cover') and \
+                float(metadata['!cloud_cover']) > max_cloud_cover:
+            skipped.append(scene_dir)
+        else:
+            planned.append(scene_dir)
+
+    return [planned, skipped]
+
+# how often the batch looks for finished scenes and dead workers
+POLL_SECONDS = 1
+
+LOST = "worker process running the scene died"
+
+# [scene, worker pid] of every scene as a worker starts it
+STARTED = [None]
+
+def warm_up(options, started):
+    STARTED[0] = started
+
+    # import the pipeline once per worker rather than once per scene
+    import simple # noqa
+
+    if "--engine=numpy" in options:
+        from lut_operations import preload_luts
+        preload_luts("--lut-cache" in options)
+
+def run_scene(scene_dir, options):
+    import simple
+
+    if not [option for option in options if option.startswith("--scratch-path=")]:
+        options = options + ["--scratch-path=" + path.join("scratch", path.basename(scene_dir))]
+
+    start = default_timer()
+    try:
+        simple.reset_config()
+        if not simple.main(options + [scene_dir]):
+            raise ValueError("simple.py did not process " + scene_dir)
+        triage = getattr(simple.config, 'TRIAGE_RESULT', {})
+        return {
+            'scene': scene_dir,
+            'status': 'triaged' if triage.get('skip') else 'success',
+            'seconds': default_timer() - start,
+            'error': triage.get('reason', ''),
+            'output': path.abspath("{0}_tiles".format(simple.config.SCENE_NAME)),
+            'metrics': getattr(simple.config, 'STAGE_METRICS', [])
+        }
+    except Exception:
+        return {
+            'scene': scene_dir,
+            'status': 'failure',
+            'seconds': default_timer() - start,
+            'error': traceback.format_exc(),
+            'metrics': []
+        }
+
+def process_scene(task):
+    [scene_dir, options, ledger] = task
+    STARTED[0].put([scene_dir, getpid()])
+
+    # a scene left running by a crashed batch is simply run again
+    mark_scene(ledger, scene_dir, 'running')
+    result = run_scene(scene_dir, options)
+    mark_scene(
+        ledger, scene_dir, result['status'], result['seconds'], result['error'],
+        result.get('output', ''))
+
+    if result['status'] in FINISHED:
+        forget_scene(ledger, scene_dir)
+    return result
+
+def is_alive(pid):
+    try:
+        kill(pid, 0)
+        return True
+    except OSError:
+        return False
+
+def lost_scene(scene_dir, ledger):
+    mark_scene(ledger, scene_dir, 'failure', None, LOST)
+    return {'scene': scene_dir, 'status': 'failure', 'seconds': 0, 'error': LOST, 'metrics': []}
+
+def run_scenes(pool, started, tasks):
+    # yields every scene's result, a Pool never returns the task of a worker
+    # that was killed (by the OOM killer, say), so those are watched for here
+    pending = dict((task[0], [task, pool.apply_async(process_scene, [task])]) for task in tasks)
+    workers = {}
+
+    while pending:
+        try:
+            while True:
+                [scene_dir, pid] = started.get_nowait()
+                workers[scene_dir] = pid
+        except Empty:
+            pass
+
+        for scene_dir in sorted(pending):
+            [task, result] = pending[scene_dir]
+            if result.ready():
+                del pending[scene_dir]
+                yield result.get()
+            elif scene_dir in workers and not is_alive(workers[scene_dir]):
+                del pending[scene_dir]
+                yield lost_scene(scene_dir, task[2])
+
+        if pending:
+            sleep(POLL_SECONDS)
+
+def main():
+    workers = 4
+    summary = "batch_summary.csv"
+    index_file = "metadata_index.json"
+    max_cloud_cover = None
+    ledger = "batch_ledger.sqlite"
+    resume = False
+    source_dir = ''
+    options = []
+
+    for arg in argv[1:]:
+        if arg.startswith("--workers="):
+            workers = int(arg.split("=")[1])
+        elif arg.startswith("--summary="):
+            summary = arg.split("=")[1]
+        elif arg.startswith("--metadata-index="):
+            index_file = arg.split("=")[1]
+        elif arg.startswith("--max-cloud-cover="):
+            max_cloud_cover = float(arg.split("=")[1])
+        elif arg.startswith("--ledger="):
+            ledger = arg.split("=")[1]
+        elif arg == "--resume":
+            resume = True
+        elif arg.startswith("-"):
+            options.append(arg)
+        elif source_dir == '':
+            source_dir = arg
+        else:
+            options.append(arg)
+
+    if source_dir == '' or "--help" in options or "-?" in options:
+        usage()
+        return
+
+    from simple import with_action
+    options = with_action(options)
+
+    logger = logging.getLogger("batch")
+    logger.setLevel(logging.INFO)
+
+    # convert is already parallel across scenes, don't oversubscribe cores
+    environ.setdefault("MAGICK_THREAD_LIMIT", "1")
+
+    scenes = find_scenes(source_dir)
+    index = index_metadata(source_dir, index_file)
+    [scenes, skipped] = plan_scenes(scenes, index, max_cloud_cover)
+    ledger = path.abspath(ledger)
+    options = options + ["--metadata-index=" + path.abspath(index_file), "--ledger=" + ledger]
+
+    finished = []
+    if resume:
+        statuses = finished_scenes(ledger)
+        finished = [scene_dir for scene_dir in scenes if scene_id(scene_dir) in statuses]
+        scenes = [scene_dir for scene_dir in scenes if scene_dir not in finished]
+        options = options + ["--resume"]
+        logger.info("Resuming, " + str(len(finished)) + " scenes already finished")
+
+    if skipped:
+        logger.info("Skipping " + str(len(skipped)) + " scenes over " +
+                    str(max_cloud_cover) + "% cloud cover")
+    logger.info("Processing " + str(len(scenes)) + " scenes with " + str(workers) + " workers")
+
+    for scene_dir in skipped:
+        mark_scene(ledger, scene_dir, 'skipped')
+
+    results = [
+        {'scene': scene_dir, 'status': 'skipped', 'seconds': 0, 'error': '', 'metrics': []}
+        for scene_dir in skipped]
+    results += [
+        {'scene': scene_dir, 'status': statuses[scene_id(scene_dir)], 'seconds': 0,
+         'error': '', 'metrics': []}
+        for scene_dir in finished]
+    done = len(results)
+
+    started = Queue()
+    pool = Pool(workers, initializer=warm_up, initargs=(options, started))
+    lost = False
+    try:
+        tasks = [[scene_dir, options, ledger] for scene_dir in scenes]
+        for result in run_scenes(pool, started, tasks):
+            lost = lost or result['error'] == LOST
+            results.append(result)
+            logger.info("{0} {1} in {2:.1f}s ({3}/{4})".format(
+                result['scene'], result['status'], result['seconds'],
+                len(results) - done, len(scenes)))
+            if result['status'] == 'failure':
+                logger.error(result['error'])
+    finally:
+        # the pool would wait forever on a lost task
+        if lost:
+            pool.terminate()
+        else:
+            pool.close()
+        pool.join()
+
+    statuses = [result['status'] for result in results]
+    logger.info("{0} scenes succeeded, {1} triaged, {2} failed".format(
+        statuses.count('success'), statuses.count('triaged'), statuses.count('failure')))
+
+    write_batch_summary(summary, sorted(results, key=lambda k: k['scene']))
+
+    if "--metrics" in options:
+        reports = [{'stages': result['metrics']} for result in results if result['metrics']]
+        with open(path.splitext(summary)[0] + "_metrics.json", 'w') as metrics_file:
+            json.dump(aggregate_metrics(reports), metrics_file, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,388 @@
+from __future__ import division
+from os import path, makedirs
+from shutil import rmtree, move
+from sys import argv, exit
+from timeit import default_timer
+import json
+import logging
+import platform
+
+import numpy as np
+from PIL import Image
+
+from file_operations import get_files_by_extension
+from tile_operations import tile_count
+
+logging.basicConfig(
+    format='[ff-import %(name)s] %(levelname)s %(asctime)-15s %(message)s'
+)
+
+# pixel_qa values the mask LUTs pick out
+FILL = 1
+CLEAR_LAND = 322
+WATER = 324
+SNOW = 336
+CLOUD = 386
+
+# blocks clouds are laid out in, roughly the size of a real cloud field
+CLOUD_BLOCK = 500
+
+# timings this short are too noisy to call slower than the baseline
+MIN_SECONDS = 0.05
+
+# simple.py stages reported together
+STAGE_GROUPS = [
+    ['triage', ['triage']],
+    ['masks', ['water_mask', 'cloud_mask', 'snow_mask']],
+    ['clamp_boost', ['red', 'green', 'blue', 'boost']],
+    ['assemble', ['assemble', 'stream']],
+    ['slice', ['slice']],
+    ['rules', ['land_mask_tiles', 'cloud_mask_tiles', 'cloud_rules', 'land_rules']],
+    ['visualize', ['visualize']],
+    ['manifest', ['csv', 'copy', 'manifest', 'columnar']]
+]
+
+def usage():
+    print("""
+benchmark.py (Pipeline Benchmark)
+
+python benchmark.py [--option] [simple.py options]
+
+Writes synthetic Landsat 8 scenes, with band TIFFs, a pixel_qa TIFF and an
+ESPA XML, for every combination of the sizes and fractions below, then runs
+simple.py over each one and reports the time of every group of stages and
+of the whole run, in seconds, megapixels per second and tiles per second.
+Any option not listed below is passed on to simple.py, with --full added
+unless one of its actions is given. Run it from the repository, like
+simple.py.
+
+    --sizes=WxH,...         Scene sizes in pixels (default 2000x2000)
+    --cloud-fractions=X,... Fraction of each scene under cloud (default 0.2)
+    --land-fractions=X,...  Fraction of each scene that is land (default 0.3)
+    --seed=N                Seed the synthetic bands and clouds (default 0)
+
+    --repeat=N              Runs of each scene, the median is reported
+                            (default 3)
+    --workdir=MY_PATH       Where scenes and their tiles are written
+                            (default benchmark)
+    --output=MY_FILE        Where to write the report
+                            (default MY_PATH/benchmark.json)
+
+    --baseline=MY_FILE      Compare against a report saved earlier, exiting
+                            with an error when a scene got slower than the
+                            tolerance or sorted its tiles differently
+    --tolerance=XX          Percent slower than the baseline still accepted
+                            (default 10)
+    --save-baseline=MY_FILE Also write the report to MY_FILE to compare
+                            later runs against
+    """)
+
+def parse_sizes(value):
+    return [[int(number) for number in size.split("x")] for size in value.split(",")]
+
+def parse_fractions(value):
+    return [float(number) for number in value.split(",")]
+
+def median(values):
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    if len(ordered) % 2:
+        return ordered[middle]
+    return (ordered[middle - 1] + ordered[middle]) / 2
+
+def scene_name(width, height, cloud_fraction, land_fraction):
+    return "LC08_BENCH_{0}x{1}_C{2:03d}_L{3:03d}".format(
+        width, height, int(round(cloud_fraction * 100)), int(round(land_fraction * 100)))
+
+def cloud_field(width, height, cloud_fraction, rng):
+    # random blocks, the highest scoring of which are clouds
+    rows = height // CLOUD_BLOCK + 1
+    cols = width // CLOUD_BLOCK + 1
+    scores = rng.rand(rows, cols)
+    cutoff = np.percentile(scores, 100 * (1 - cloud_fraction)) if cloud_fraction > 0 else 2
+    clouds = scores >= cutoff
+    clouds = np.repeat(np.repeat(clouds, CLOUD_BLOCK, axis=0), CLOUD_BLOCK, axis=1)
+    return clouds[:height, :width]
+
+def pixel_qa(width, height, cloud_fraction, land_fraction, rng):
+    qa = np.full((height, width), WATER, np.uint16)
+    qa[:, :int(round(width * land_fraction))] = CLEAR_LAND
+    qa[cloud_field(width, height, cloud_fraction, rng)] = CLOUD
+
+    # a sliver of snow and a fill border, as on real scenes
+    qa[height // 2:height // 2 + height // 50, :width // 10] = SNOW
+    qa[:, :width // 100] = FILL
+    return qa
+
+def band(qa, rng):
+    pixels = rng.randint(-100, 3000, size=qa.shape).astype(np.int16)
+    pixels[qa == WATER] //= 4
+    pixels[qa == CLOUD] = 6000
+    pixels[qa == FILL] = -9999
+    return pixels
+
+def metadata_xml(width, height, cloud_cover, water_cover):
+    # 30m pixels, in UTM zone 11
+    return """<?xml version="1.0" encoding="UTF-8"?>
+<espa_metadata version="2.0" xmlns="http://espa.cr.usgs.gov/v2">
+    <global_metadata>
+        <satellite>LANDSAT_8</satellite>
+        <instrument>OLI_TIRS</instrument>
+        <acquisition_date>2017-06-01</acquisition_date>
+        <scene_center_time>18:30:00.0000000Z</scene_center_time>
+        <solar_angles zenith="30.0" azimuth="120.0" units="degrees"/>
+        <earth_sun_distance>1.0141</earth_sun_distance>
+        <projection_information projection="UTM" datum="WGS84" units="meters">
+            <corner_point location="UL" x="300000.000000" y="4000000.000000"/>
+            <corner_point location="LR" x="{0:.6f}" y="{1:.6f}"/>
+            <utm_proj_params>
+                <zone_code>11</zone_code>
+            </utm_proj_params>
+        </projection_information>
+    </global_metadata>
+    <bands>
+        <band name="cfmask">
+            <percent_coverage>
+                <cover type="cloud">{2:.2f}</cover>
+                <cover type="water">{3:.2f}</cover>
+            </percent_coverage>
+        </band>
+    </bands>
+</espa_metadata>
+""".format(300000 + 30 * width, 4000000 - 30 * height, cloud_cover, water_cover)
+
+def synthesize_scene(scene_dir, width, height, cloud_fraction, land_fraction, seed):
+    from simple import LANDSAT8
+
+    name = path.basename(scene_dir)
+    if path.exists(scene_dir):
+        rmtree(scene_dir)
+    makedirs(scene_dir)
+
+    rng = np.random.RandomState(seed)
+    qa = pixel_qa(width, height, cloud_fraction, land_fraction, rng)
+    Image.fromarray(qa).save(path.join(scene_dir, name + "_pixel_qa.tif"))
+
+    for band_name in sorted(set(LANDSAT8.values())):
+        Image.fromarray(band(qa, rng)).save(
+            path.join(scene_dir, name + "_sr_" + band_name + ".tif"))
+
+    with open(path.join(scene_dir, name + ".xml"), 'w') as xml:
+        xml.write(metadata_xml(
+            width, height,
+            100 * np.mean(qa == CLOUD),
+            100 * np.mean(qa == WATER)))
+
+def stage_seconds(metrics):
+    seconds = dict((name, 0.0) for [name, _] in STAGE_GROUPS)
+    for record in metrics:
+        for [name, stages] in STAGE_GROUPS:
+            if record['stage'] in stages:
+                seconds[name] += record['wall_seconds']
+    return seconds
+
+def run_scene(scene_dir, options, output_dir):
+    import simple
+
+    name = path.basename(scene_dir)
+    tiles_dir = "{0}_tiles".format(name)
+
+    start = default_timer()
+    simple.reset_config()
+    processed = simple.main(options + ["--metrics", scene_dir])
+    seconds = default_timer() - start
+
+    if not processed or not path.isdir(path.join(tiles_dir, "accepted")):
+        raise ValueError("simple.py {0} wrote no {1}, nothing to measure".format(
+            " ".join(options), tiles_dir))
+
+    accepted = get_files_by_extension(path.join(tiles_dir, "accepted"), "png")
+    metrics = getattr(simple.config, 'STAGE_METRICS', [])
+
+    # keep the repository clean, the last run's tiles stay in the workdir
+    target = path.join(output_dir, tiles_dir)
+    if path.exists(target):
+        rmtree(target)
+    move(tiles_dir, target)
+
+    return [seconds, stage_seconds(metrics), sorted(accepted)]
+
+def benchmark_scene(scene_dir, width, height, options, repeat, output_dir, grid_size):
+    logger = logging.getLogger("benchmark")
+    runs = []
+
+    for attempt in range(repeat):
+        runs.append(run_scene(scene_dir, options, output_dir))
+        logger.info("{0} run {1}/{2} in {3:.2f}s".format(
+            path.basename(scene_dir), attempt + 1, repeat, runs[-1][0]))
+
+    megapixels = width * height / 1e6
+    tiles = tile_count(width, height, grid_size)
+    end_to_end = median([run[0] for run in runs])
+
+    stages = {}
+    for [name, _] in STAGE_GROUPS:
+        seconds = median([run[1][name] for run in runs])
+        if seconds > 0:
+            stages[name] = {
+                'seconds': seconds,
+                'megapixels_per_second': megapixels / seconds
+            }
+
+    return {
+        'width': width,
+        'height': height,
+        'megapixels': megapixels,
+        'tiles': tiles,
+        'accepted': runs[-1][2],
+        'seconds': end_to_end,
+        'megapixels_per_second': megapixels / end_to_end,
+        'tiles_per_second': tiles / end_to_end,
+        'stages': stages
+    }
+
+def compare(report, baseline, tolerance):
+    # [lines describing each scene, whether any scene regressed]
+    lines = []
+    regressed = False
+    limit = 1 + tolerance / 100
+
+    for name in sorted(report['scenes']):
+        current = report['scenes'][name]
+        previous = baseline['scenes'].get(name)
+        if previous is None:
+            lines.append("{0}: not in baseline".format(name))
+            continue
+
+        if current['accepted'] != previous['accepted']:
+            regressed = True
+            lines.append("{0}: accepted {1} tiles, baseline accepted {2}".format(
+                name, len(current['accepted']), len(previous['accepted'])))
+
+        timings = [['total', current['seconds'], previous['seconds']]]
+        for stage_name in sorted(current['stages']):
+            if stage_name in previous['stages']:
+                timings.append([
+                    stage_name,
+                    current['stages'][stage_name]['seconds'],
+                    previous['stages'][stage_name]['seconds']])
+
+        for [stage_name, seconds, baseline_seconds] in timings:
+            ratio = seconds / baseline_seconds if baseline_seconds else 1.0
+            slower = ratio > limit and seconds >= MIN_SECONDS
+            regressed = regressed or slower
+            lines.append("{0} {1}: {2:.3f}s against {3:.3f}s ({4:+.1f}%){5}".format(
+                name, stage_name, seconds, baseline_seconds, 100 * (ratio - 1),
+                " SLOWER" if slower else ""))
+
+    return [lines, regressed]
+
+def main():
+    sizes = [[2000, 2000]]
+    cloud_fractions = [0.2]
+    land_fractions = [0.3]
+    seed = 0
+    repeat = 3
+    workdir = "benchmark"
+    output = ''
+    baseline_file = ''
+    tolerance = 10.0
+    save_baseline = ''
+    options = []
+
+    for arg in argv[1:]:
+        if arg == "--help" or arg == "-?":
+            usage()
+            return
+        elif arg.startswith("--sizes="):
+            sizes = parse_sizes(arg.split("=")[1])
+        elif arg.startswith("--cloud-fractions="):
+            cloud_fractions = parse_fractions(arg.split("=")[1])
+        elif arg.startswith("--land-fractions="):
+            land_fractions = parse_fractions(arg.split("=")[1])
+        elif arg.startswith("--seed="):
+            seed = int(arg.split("=")[1])
+        elif arg.startswith("--repeat="):
+            repeat = int(arg.split("=")[1])
+        elif arg.startswith("--workdir="):
+            workdir = arg.split("=")[1]
+        elif arg.startswith("--output="):
+            output = arg.split("=")[1]
+        elif arg.startswith("--baseline="):
+            baseline_file = arg.split("=")[1]
+        elif arg.startswith("--tolerance="):
+            tolerance = float(arg.split("=")[1])
+        elif arg.startswith("--save-baseline="):
+            save_baseline = arg.split("=")[1]
+        else:
+            options.append(arg)
+
+    from simple import with_action, config
+    options = with_action(options)
+
+    logger = logging.getLogger("benchmark")
+    logger.setLevel(logging.INFO)
+
+    scenes_dir = path.join(workdir, "scenes")
+    output_dir = path.join(workdir, "tiles")
+    for directory in [scenes_dir, output_dir]:
+        if not path.exists(directory):
+            makedirs(directory)
+
+    # the grid size simple.py will slice with, given its options
+    grid_size = config.GRID_SIZE
+    for option in options:
+        if option.startswith("--grid-size="):
+            grid_size = int(option.split("=")[1])
+
+    report = {
+        'options': options,
+        'repeat': repeat,
+        'seed': seed,
+        'python': platform.python_version(),
+        'scenes': {}
+    }
+
+    for [width, height] in sizes:
+        for cloud_fraction in cloud_fractions:
+            for land_fraction in land_fractions:
+                name = scene_name(width, height, cloud_fraction, land_fraction)
+                scene_dir = path.join(scenes_dir, name)
+
+                logger.info("Writing synthetic scene " + name)
+                synthesize_scene(scene_dir, width, height, cloud_fraction, land_fraction, seed)
+
+                result = benchmark_scene(
+                    scene_dir, width, height, options, repeat, output_dir, grid_size)
+                report['scenes'][name] = result
+
+                logger.info("{0}: {1:.2f}s, {2:.2f} megapixels/s, {3:.1f} tiles/s, "
+                            "{4} of {5} tiles accepted".format(
+                                name, result['seconds'], result['megapixels_per_second'],
+                                result['tiles_per_second'], len(result['accepted']),
+                                result['tiles']))
+                for [stage_name, _] in STAGE_GROUPS:
+                    if stage_name in result['stages']:
+                        logger.info("    {0}: {1:.3f}s, {2:.2f} megapixels/s".format(
+                            stage_name, result['stages'][stage_name]['seconds'],
+                            result['stages'][stage_name]['megapixels_per_second']))
+
+    for report_file in [output or path.join(workdir, "benchmark.json"), save_baseline]:
+        if report_file:
+            with open(report_file, 'w') as json_file:
+                json.dump(report, json_file, indent=2, sort_keys=True)
+
+    if baseline_file:
+        with open(baseline_file) as json_file:
+            baseline = json.load(json_file)
+
+        [lines, regressed] = compare(report, baseline, tolerance)
+        for line in lines:
+            logger.info(line)
+
+        if regressed:
+            logger.error("Slower than or different from the baseline " + baseline_file)
+            exit(1)
+
+if __name__ == "__main__":
+    main()
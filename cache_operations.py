@@ -0,0 +1,109 @@
+from os import path, listdir, stat
+import hashlib
+import json
+import logging
+import threading
+
+from ledger_operations import stage_complete, complete_stage
+
+CACHE_FILE = "stage_cache.json"
+
+LOCK = threading.Lock()
+DIGESTS = {}
+
+def code_version():
+    # any edit to the pipeline's own modules invalidates every cached stage
+    with LOCK:
+        if 'code' not in DIGESTS:
+            digest = hashlib.sha1()
+            source_dir = path.dirname(path.abspath(__file__))
+            for filename in sorted(listdir(source_dir)):
+                if filename.endswith(".py"):
+                    with open(path.join(source_dir, filename), 'rb') as source:
+                        digest.update(source.read())
+            DIGESTS['code'] = digest.hexdigest()
+        return DIGESTS['code']
+
+def on_disk(a_file):
+    # npy scratch keeps an intermediate under a different extension
+    for candidate in [a_file, path.splitext(a_file)[0] + ".npy"]:
+        if path.exists(candidate):
+            return candidate
+    return None
+
+def file_signature(a_file):
+    actual = on_disk(a_file)
+    if actual is None:
+        return [a_file, None]
+    info = stat(actual)
+    return [path.abspath(actual), info.st_size, info.st_mtime]
+
+def content_digest(a_file):
+    signature = tuple(file_signature(a_file))
+    with LOCK:
+        if signature not in DIGESTS:
+            with open(a_file, 'rb') as contents:
+                DIGESTS[signature] = hashlib.sha1(contents.read()).hexdigest()
+        return DIGESTS[signature]
+
+def stage_key(name, inputs, luts, parameters):
+    description = [
+        name,
+        code_version(),
+        [file_signature(a_file) for a_file in inputs],
+        [content_digest(which_lut) for which_lut in luts],
+        parameters
+    ]
+    return hashlib.sha1(json.dumps(description, sort_keys=True).encode("utf-8")).hexdigest()
+
+def _cache_file(config):
+    return path.join(config.SCRATCH_PATH, CACHE_FILE)
+
+def _read_cache(config):
+    if not path.exists(_cache_file(config)):
+        return {}
+    with open(_cache_file(config)) as cache_file:
+        return json.load(cache_file)
+
+def is_cached(name, key, config):
+    if config.LEDGER:
+        return stage_complete(config.LEDGER, config.SCENE_DIR, name, key)
+
+    with LOCK:
+        entry = _read_cache(config).get(name)
+
+    if entry is None or entry['key'] != key:
+        return False
+    return all(on_disk(output) is not None for output in entry['outputs'])
+
+def record_stage(name, key, outputs, config):
+    if config.LEDGER:
+        complete_stage(
+            config.LEDGER, config.SCENE_DIR, name, key,
+            [on_disk(output) for output in outputs if on_disk(output) is not None])
+        return
+
+    with LOCK:
+        cache = _read_cache(config)
+        cache[name] = {'key': key, 'outputs': outputs}
+        with open(_cache_file(config), 'w') as cache_file:
+            json.dump(cache, cache_file, indent=2, sort_keys=True)
+
+def cached(name, function, inputs, outputs, parameters, config, luts=(), restore=None):
+    def run(*args):
+        if not config.STAGE_CACHE:
+            return function(*args)
+
+        logger = logging.getLogger(config.SCENE_NAME)
+        key = stage_key(name, inputs, luts, parameters)
+
+        if is_cached(name, key, config):
+            logger.info("Reusing cached output of " + name)
+            if restore is not None:
+                restore(config)
+            return
+
+        function(*args)
+        record_stage(name, key, outputs() if callable(outputs) else outputs, config)
+
+    return run
@@ -0,0 +1,90 @@
+from os import path, makedirs, listdir
+import json
+
+from tile_operations import tile_index
+
+STATUSES = ["Accepted", "No Water", "Too Cloudy"]
+
+STATISTICS = ['min', 'max', 'mean', 'dev']
+
+# [column, csv field, dtype] of the typed per-tile table
+COLUMNS = [
+    ['row', '#row', 'int32'],
+    ['column', '#column', 'int32'],
+    ['width', '#width', 'int32'],
+    ['height', '#height', 'int32'],
+    ['left', '#tile_UL_x', 'float64'],
+    ['top', '#tile_UL_y', 'float64'],
+    ['right', '#tile_LR_x', 'float64'],
+    ['bottom', '#tile_LR_y', 'float64'],
+    ['center_x', '#tile_center_x', 'float64'],
+    ['center_y', '#tile_center_y', 'float64'],
+    ['center_lat', 'center_lat', 'float64'],
+    ['center_lon', 'center_lon', 'float64']
+]
+
+def partition_path(root, scene_name):
+    return path.join(root, "scene=" + scene_name)
+
+def write_columnar(root, rows, statistics, config):
+    import numpy as np
+
+    columns = dict((name, []) for [name, _, _] in COLUMNS)
+    columns['tile'] = []
+    columns['status'] = []
+    for subdirectory in ["cloud", "land"]:
+        for name in STATISTICS:
+            columns[subdirectory + "_" + name] = []
+
+    for row in rows:
+        idx = tile_index(row['#filename'])
+        columns['tile'].append(idx)
+        columns['status'].append(STATUSES.index(row['#reason']))
+        for [name, field, _] in COLUMNS:
+            columns[name].append(row[field])
+
+        # tiles rejected before a rule never had its figures measured
+        for subdirectory in ["cloud", "land"]:
+            figures = statistics.get(subdirectory, {}).get(idx)
+            for position, name in enumerate(STATISTICS):
+                columns[subdirectory + "_" + name].append(
+                    float(figures[position]) if figures is not None else float('nan'))
+
+    arrays = {
+        'tile': np.array(columns.pop('tile'), dtype='int32'),
+        'status': np.array(columns.pop('status'), dtype='int8')
+    }
+    for [name, _, dtype] in COLUMNS:
+        arrays[name] = np.array(columns.pop(name), dtype=dtype)
+    for name, values in columns.items():
+        arrays[name] = np.array(values, dtype='float64')
+
+    target = partition_path(root, config.SCENE_NAME)
+    if not path.exists(target):
+        makedirs(target)
+
+    np.savez_compressed(path.join(target, "tiles.npz"), **arrays)
+
+    with open(path.join(target, "scene.json"), 'w') as scene_file:
+        json.dump({
+            'scene': config.SCENE_NAME,
+            'width': config.width,
+            'height': config.height,
+            'grid_size': config.GRID_SIZE,
+            'statuses': STATUSES,
+            'metadata': config.METADATA
+        }, scene_file, indent=2, sort_keys=True)
+
+def read_partitions(root):
+    # yields [scene metadata, {column: array}] for every scene under root
+    import numpy as np
+
+    for name in sorted(listdir(root)):
+        partition = path.join(root, name)
+        if not name.startswith("scene=") or not path.exists(path.join(partition, "tiles.npz")):
+            continue
+
+        with open(path.join(partition, "scene.json")) as scene_file:
+            scene = json.load(scene_file)
+        with np.load(path.join(partition, "tiles.npz")) as tiles:
+            yield [scene, dict((column, tiles[column]) for column in tiles.files)]
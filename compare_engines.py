@@ -0,0 +1,211 @@
+from __future__ import division
+from os import path, makedirs
+from shutil import rmtree, copyfile
+from sys import argv, exit
+import json
+import logging
+
+import numpy as np
+from PIL import Image
+
+from benchmark import synthesize_scene
+from file_operations import get_files_by_extension
+
+logging.basicConfig(
+    format='[ff-import %(name)s] %(levelname)s %(asctime)-15s %(message)s'
+)
+
+# scratch images both engines write, in pipeline order
+STAGES = [
+    "water_mask", "cloud_mask", "snow_mask", "red", "green", "blue", "boost",
+    "water", "land", "masked", "green_final", "render"]
+
+# a synthetic scene small enough to keep its reference renders in the repository
+FIXTURE = "LC08_FIXTURE"
+FIXTURE_SIZE = [800, 800]
+FIXTURE_CLOUD_FRACTION = 0.2
+FIXTURE_LAND_FRACTION = 0.3
+FIXTURE_OPTIONS = ["--grid-size=200"]
+
+def usage():
+    print("""
+compare_engines.py (Engine Reference Check)
+
+python compare_engines.py [--option] [SCENE_DIR]
+
+Runs simple.py's numpy engine over a scene and compares every stage it writes
+to scratch (masks, colour channels, composites and the render) with the same
+stage rendered by convert, along with the tiles each engine accepts. Without
+SCENE_DIR a small synthetic fixture scene is written and used. Differences
+are reported in 8 bit levels: the largest, the mean and the share of pixels
+off by half a level or more. Run it from the repository, like simple.py.
+
+    --reference=MY_PATH     Directory of convert's renders to compare with
+                            (default fixtures/engine_reference)
+    --save-reference        Render the reference with convert first, which
+                            needs ImageMagick, replacing any already there
+
+    --workdir=MY_PATH       Where the scene and the numpy renders are written
+                            (default engine_check)
+    --output=MY_FILE        Where to write the report
+                            (default MY_PATH/engine_comparison.json)
+
+    --max-difference=N      Exit with an error when any stage differs from the
+                            reference by more than N levels, the tiles accepted
+                            must always match
+    """)
+
+def levels(image_file):
+    # pixels as 8 bit levels, whatever depth the engine wrote them at
+    image = Image.open(image_file)
+    pixels = np.asarray(image).astype(np.float64)
+    if image.mode.startswith("I"):
+        pixels = pixels / 257
+    return pixels
+
+def render_stages(scene_dir, engine, scratch_dir, options):
+    # [scene name, accepted tiles], the stages are left in scratch_dir
+    import simple
+
+    simple.reset_config()
+    processed = simple.main(options + [
+        "--clean", "--generate", "--sort-tiles",
+        "--engine=" + engine, "--scratch-path=" + scratch_dir, scene_dir])
+    if not processed:
+        raise ValueError("simple.py did not process " + scene_dir)
+
+    scene = simple.config.SCENE_NAME
+    tiles_dir = "{0}_tiles".format(scene)
+    accepted = sorted(get_files_by_extension(path.join(tiles_dir, "accepted"), "png"))
+
+    # keep the repository clean, only the scratch renders are compared
+    rmtree(tiles_dir)
+    return [scene, accepted]
+
+def save_reference(scene_dir, reference_dir, options):
+    if path.exists(reference_dir):
+        rmtree(reference_dir)
+    makedirs(reference_dir)
+
+    scratch_dir = path.join(reference_dir, "scratch")
+    [scene, accepted] = render_stages(scene_dir, "convert", scratch_dir, options)
+
+    for name in STAGES:
+        copyfile(path.join(scratch_dir, name + ".png"), path.join(reference_dir, name + ".png"))
+    rmtree(scratch_dir)
+
+    with open(path.join(reference_dir, "reference.json"), 'w') as reference:
+        json.dump(
+            {'scene': scene, 'options': options, 'accepted': accepted},
+            reference, indent=2, sort_keys=True)
+
+def compare_stage(reference_file, engine_file):
+    reference = levels(reference_file)
+    rendered = levels(engine_file)
+
+    if reference.shape != rendered.shape:
+        return {'shape': [list(reference.shape), list(rendered.shape)]}
+
+    difference = np.abs(reference - rendered)
+    return {
+        'max_difference': float(difference.max()),
+        'mean_difference': float(difference.mean()),
+        'differing': float(np.mean(difference >= 0.5))
+    }
+
+def main():
+    reference_dir = path.join("fixtures", "engine_reference")
+    render_reference = False
+    workdir = "engine_check"
+    output = ''
+    max_difference = None
+    scene_dir = ''
+    options = []
+
+    for arg in argv[1:]:
+        if arg == "--help" or arg == "-?":
+            usage()
+            return
+        elif arg.startswith("--reference="):
+            reference_dir = arg.split("=")[1]
+        elif arg == "--save-reference":
+            render_reference = True
+        elif arg.startswith("--workdir="):
+            workdir = arg.split("=")[1]
+        elif arg.startswith("--output="):
+            output = arg.split("=")[1]
+        elif arg.startswith("--max-difference="):
+            max_difference = float(arg.split("=")[1])
+        elif arg.startswith("-"):
+            options.append(arg)
+        else:
+            scene_dir = arg
+
+    logger = logging.getLogger("compare")
+    logger.setLevel(logging.INFO)
+
+    if scene_dir == '':
+        scene_dir = path.join(workdir, "scenes", FIXTURE)
+        options = FIXTURE_OPTIONS + options
+        logger.info("Writing fixture scene " + FIXTURE)
+        [width, height] = FIXTURE_SIZE
+        synthesize_scene(
+            scene_dir, width, height, FIXTURE_CLOUD_FRACTION, FIXTURE_LAND_FRACTION, 0)
+
+    if render_reference:
+        logger.info("Rendering the convert reference into " + reference_dir)
+        save_reference(scene_dir, reference_dir, options)
+
+    if not path.exists(path.join(reference_dir, "reference.json")):
+        logger.error("No reference in {0}, render one with --save-reference".format(
+            reference_dir))
+        exit(1)
+
+    with open(path.join(reference_dir, "reference.json")) as reference_file:
+        reference = json.load(reference_file)
+
+    scratch_dir = path.join(workdir, "numpy")
+    [scene, accepted] = render_stages(scene_dir, "numpy", scratch_dir, options)
+    if scene != reference['scene']:
+        logger.error("The reference is of {0}, not {1}".format(reference['scene'], scene))
+        exit(1)
+
+    report = {
+        'scene': scene,
+        'options': options,
+        'accepted': accepted,
+        'reference_accepted': reference['accepted'],
+        'stages': {}
+    }
+
+    failed = accepted != reference['accepted']
+    for name in STAGES:
+        result = compare_stage(
+            path.join(reference_dir, name + ".png"), path.join(scratch_dir, name + ".png"))
+        report['stages'][name] = result
+
+        if 'shape' in result:
+            failed = True
+            logger.info("{0}: reference is {1}, numpy wrote {2}".format(
+                name, result['shape'][0], result['shape'][1]))
+            continue
+
+        failed = failed or (
+            max_difference is not None and result['max_difference'] > max_difference)
+        logger.info("{0}: max {1:.1f}, mean {2:.3f} levels, {3:.2f}% of pixels differ".format(
+            name, result['max_difference'], result['mean_difference'],
+            100 * result['differing']))
+
+    logger.info("numpy accepted {0} tiles, convert accepted {1}, {2} in common".format(
+        len(accepted), len(reference['accepted']),
+        len(set(accepted) & set(reference['accepted']))))
+
+    with open(output or path.join(workdir, "engine_comparison.json"), 'w') as json_file:
+        json.dump(report, json_file, indent=2, sort_keys=True)
+
+    if failed:
+        logger.error("The numpy engine differs from the reference in " + reference_dir)
+        exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,42 +1,183 @@
 import csv
+import shutil
+import tempfile
 
-def write_manifest(csv_filename, accepted):
-    if not accepted or len(accepted) < 1:
-        return
+from tile_operations import tile_index
 
-    with open(csv_filename, 'w') as csvfile:
+# every tile record carries these, on top of the scene metadata
+TILE_FIELDS = [
+    '#filename', '#reason', '#row', '#column', '#width', '#height',
+    '#tile_UL_x', '#tile_UL_y', '#tile_UR_x', '#tile_UR_y',
+    '#tile_LL_x', '#tile_LL_y', '#tile_LR_x', '#tile_LR_y',
+    '#tile_center_x', '#tile_center_y', 'center_lat', 'center_lon', 'map_link'
+]
+
+def _schema(leading, metadata, excluded=()):
+    fieldnames = list(leading)
+
+    for key in sorted(set(TILE_FIELDS) | set(metadata.keys())):
+        if key in excluded:
+            continue
+
+        if not key in fieldnames:
+            fieldnames.append(key)
+
+    return fieldnames
+
+def manifest_schema(metadata):
+    return _schema(['#filename', '#row', '#column'], metadata, ['#reason'])
+
+def rejects_schema(metadata):
+    return _schema(['#filename', '#reason', '#row', '#column'], metadata)
+
+
+def write_rows(csv_filename, fieldnames, rows):
+    # rows may be any iterator, the file is only created for a first row
+    csvfile = None
+    try:
+        for row in rows:
+            if csvfile is None:
+                csvfile = open(csv_filename, 'w')
+                writer = csv.DictWriter(csvfile, fieldnames=fieldnames, extrasaction='ignore')
+                writer.writeheader()
+
+            writer.writerow(row)
+    finally:
+        if csvfile is not None:
+            csvfile.close()
+
+
+def _drop_rows(csvfile, header, key, value):
+    # rewritten in place, workers waiting on the lock keep appending to this file
+    column = header.index(key)
+    kept = tempfile.TemporaryFile(mode='w+')
+    dropped = False
+
+    csvfile.seek(0)
+    for line in csvfile:
+        if value in line and next(csv.reader([line]))[column] == value:
+            dropped = True
+        else:
+            kept.write(line)
+
+    if dropped:
+        kept.seek(0)
+        csvfile.seek(0)
+        csvfile.truncate(0)
+        shutil.copyfileobj(kept, csvfile)
+    kept.close()
+
+
+def append_rows(csv_filename, fieldnames, rows, replace=None):
+    import fcntl
+
+    # workers of a batch share the file, each block of rows goes in whole,
+    # replace=[key, value] first drops the rows an earlier run wrote for value
+    with open(csv_filename, 'a+') as csvfile:
+        fcntl.flock(csvfile, fcntl.LOCK_EX)
+        try:
+            csvfile.seek(0)
+            line = csvfile.readline()
+            header = next(csv.reader([line])) if line else None
+            if header is not None and header != fieldnames:
+                raise ValueError("{0} has other columns than {1}".format(
+                    csv_filename, ",".join(fieldnames)))
+
+            if header is not None and replace is not None:
+                _drop_rows(csvfile, header, replace[0], replace[1])
+
+            csvfile.seek(0, 2)
+            writer = csv.DictWriter(csvfile, fieldnames=fieldnames, extrasaction='ignore')
 
-        fieldnames = ['#filename', '#row', '#column']
+            if header is None and rows:
+                writer.writeheader()
 
-        for key in sorted(accepted[0].keys()):
-            if key == "#reason":
-                continue
+            for row in rows:
+                writer.writerow(row)
 
-            if not key in fieldnames:
-                fieldnames.append(key)
+            csvfile.flush()
+        finally:
+            fcntl.flock(csvfile, fcntl.LOCK_UN)
+
+
+def write_batch_summary(csv_filename, results):
+    with open(csv_filename, 'w') as csvfile:
+
+        fieldnames = ['scene', 'status', 'seconds', 'error']
 
         writer = csv.DictWriter(csvfile, fieldnames=fieldnames, extrasaction='ignore')
 
         writer.writeheader()
 
-        for subject in accepted:
-            writer.writerow(subject)
+        for result in results:
+            writer.writerow(result)
+
+
+STATISTICS = ['min', 'max', 'mean', 'dev']
+
+def write_tile_statistics(csv_filename, filenames, statistics, config):
+    with open(csv_filename, 'w') as csvfile:
+
+        fieldnames = ['#filename', '#scene_width', '#scene_height', '#grid_size']
+        for subdirectory in sorted(statistics.keys()):
+            for name in STATISTICS:
+                fieldnames.append(subdirectory + "_" + name)
+
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+
+        writer.writeheader()
+
+        for filename in sorted(filenames):
+            row = {
+                '#filename': filename,
+                '#scene_width': config.width,
+                '#scene_height': config.height,
+                '#grid_size': config.GRID_SIZE
+            }
+            for subdirectory, table in statistics.items():
+                for name, value in zip(STATISTICS, table[tile_index(filename)]):
+                    row[subdirectory + "_" + name] = value
+            writer.writerow(row)
+
+
+def read_tile_statistics(csv_filename):
+    filenames = []
+    statistics = {}
+    scene = {}
+
+    with open(csv_filename) as csvfile:
+        reader = csv.DictReader(csvfile)
+
+        subdirectories = sorted(set(
+            field.rsplit("_", 1)[0] for field in reader.fieldnames if not field.startswith("#")))
+        for subdirectory in subdirectories:
+            statistics[subdirectory] = {}
+
+        for row in reader:
+            filename = row['#filename']
+            filenames.append(filename)
+            scene = {
+                'width': int(row['#scene_width']),
+                'height': int(row['#scene_height']),
+                'grid_size': int(row['#grid_size'])
+            }
+            for subdirectory in subdirectories:
+                statistics[subdirectory][tile_index(filename)] = [
+                    float(row[subdirectory + "_" + name]) for name in STATISTICS]
 
+    return [filenames, statistics, scene]
 
-def write_rejects(csv_filename, rejects):
-    if not rejects or len(rejects) < 1:
-        return
 
+def write_tuning(csv_filename, results):
     with open(csv_filename, 'w') as csvfile:
 
-        fieldnames = ['#filename', '#reason', '#row', '#column']
-        for key in sorted(rejects[0].keys()):
-            if not key in fieldnames:
-                fieldnames.append(key)
+        fieldnames = [
+            'scene', 'land_threshhold', 'land_sensitivity', 'cloud_threshhold',
+            'cloud_sensitivity', 'accepted', 'no_water', 'too_cloudy']
 
         writer = csv.DictWriter(csvfile, fieldnames=fieldnames, extrasaction='ignore')
 
         writer.writeheader()
 
-        for reject in rejects:
-            writer.writerow(reject)
+        for result in results:
+            writer.writerow(result)
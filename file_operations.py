@@ -1,36 +1,99 @@
 import logging
-from os import path, mkdir, listdir
+from multiprocessing.pool import ThreadPool
+from os import path, mkdir, makedirs, listdir, link, rename, remove
 from shutil import rmtree, copy
 import tempfile
 
+# linux ioctl that shares the source's blocks with the target (btrfs, xfs)
+FICLONE = 0x40049409
+
 def find_scene_name(config):
+    # scene directories are usually named after their metadata file
+    name = path.basename(path.normpath(config.SCENE_DIR))
+    if path.exists(path.join(config.SCENE_DIR, name + ".xml")):
+        return name
+
     files = get_files_by_extension(config.SCENE_DIR, "xml")
     return path.splitext(files[0])[0]
 
-def accept_tile(filename, config):
-    copy(
-        path.join(config.SCRATCH_PATH, "scene", filename),
-        path.join("{0}_tiles".format(config.SCENE_NAME), "accepted", filename)
-    )
-
-def reject_tile(filename, config):
-    copy(
-        path.join(config.SCRATCH_PATH, "scene", filename),
-        path.join("{0}_tiles".format(config.SCENE_NAME), "rejected", filename)
-    )
+def reflink(source, target):
+    import fcntl
+
+    with open(source, 'rb') as source_file:
+        with open(target, 'wb') as target_file:
+            try:
+                fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+            except EnvironmentError:
+                target_file.close()
+                remove(target)
+                raise
+
+PLACERS = {
+    'hardlink': link,
+    'reflink': reflink,
+    'move': rename,
+    'copy': copy
+}
+
+def placement_order(config):
+    if config.PLACEMENT != "auto":
+        # copy always works, so every strategy can fall back on it
+        return [config.PLACEMENT, "copy"]
+
+    # the scratch tiles are only moved when the scratch directory goes away
+    if config.WITHTEMPDIR:
+        return ["move", "hardlink", "reflink", "copy"]
+    return ["hardlink", "reflink", "copy"]
+
+def place_tile(filename, destination, config):
+    source = path.join(config.SCRATCH_PATH, "scene", filename)
+    target = path.join("{0}_tiles".format(config.SCENE_NAME), destination, filename)
+
+    # a kept tile may share its blocks with the source, never write through it
+    if path.lexists(target):
+        remove(target)
+
+    for strategy in placement_order(config):
+        try:
+            PLACERS[strategy](source, target)
+            return strategy
+        except EnvironmentError:
+            # cross device, unsupported by the filesystem, or not permitted
+            if strategy == "copy":
+                raise
+
+def place_tiles(filenames, destination, config):
+    logger = logging.getLogger(config.SCENE_NAME)
 
-def build_output(scene_name):
+    if config.PLACEMENT_WORKERS > 1 and len(filenames) > config.PLACEMENT_WORKERS:
+        pool = ThreadPool(config.PLACEMENT_WORKERS)
+        try:
+            strategies = pool.map(
+                lambda filename: place_tile(filename, destination, config), filenames)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        strategies = [place_tile(filename, destination, config) for filename in filenames]
+
+    for strategy in sorted(set(strategies)):
+        logger.info("Placed {0} {1} tiles by {2}".format(
+            strategies.count(strategy), destination, strategy))
+
+def build_output(scene_name, keep=False):
     logger = logging.getLogger(scene_name)
     target = "{0}_tiles".format(scene_name)
 
-    if path.exists(target):
+    if path.exists(target) and keep:
+        logger.info("Keeping existing output tiles")
+    elif path.exists(target):
         logger.info("Removing existing output tiles")
         rmtree(target)
 
     logger.info("Building output subdirectories")
-    mkdir(target)
-    mkdir(path.join(target, "accepted"))
-    mkdir(path.join(target, "rejected"))
+    for directory in [target, path.join(target, "accepted"), path.join(target, "rejected")]:
+        if not path.exists(directory):
+            mkdir(directory)
 
 def scratch_exists(config):
     return path.exists(config.SCRATCH_PATH)
@@ -50,7 +113,7 @@ def build_scratch(config):
         rmtree(scratch_path)
 
     if not config.WITHTEMPDIR:
-        mkdir(scratch_path)
+        makedirs(scratch_path)
 
     logger.info("Building scratch tile directories")
     mkdir(path.join(scratch_path, "land"))
@@ -70,6 +133,6 @@ def get_files_by_extension(filepath, extension):
 
 def maybe_clean_scratch(config):
     logger = logging.getLogger(config.SCENE_NAME)
-    if config.WITHTEMPDIR:
+    if config.WITHTEMPDIR or config.RESUME:
         logger.info("attempting to clean up scratch directory")
         rmtree(config.SCRATCH_PATH)
@@ -1,19 +1,33 @@
 from __future__ import division
+import threading
+
 from pyproj import Proj
 
+PROJECTIONS = {}
+LOCK = threading.Lock()
+
+def projection(utm_zone):
+    zone = str(abs(int(utm_zone)))
+    with LOCK:
+        if zone not in PROJECTIONS:
+            PROJECTIONS[zone] = Proj(proj='utm', zone=zone, ellps='WGS84')
+        return PROJECTIONS[zone]
+
 def compute_lat_lon(x, y, utm_zone):
-    p = Proj(proj='utm', zone=str(abs(int(utm_zone))), ellps='WGS84')
-    lat, lon = p(x, y, inverse=True)
+    # x and y may be lists, which are transformed in a single call
+    lat, lon = projection(utm_zone)(x, y, inverse=True)
     return [lat, lon]
 
-def compute_tile_coords(row, col, width, height, config):
+def scene_extent(config):
     scene_top = float(config.METADATA["#scene_corner_UL_y"])
     scene_bottom = float(config.METADATA["#scene_corner_LR_y"])
     scene_left = float(config.METADATA["#scene_corner_UL_x"])
     scene_right = float(config.METADATA["#scene_corner_LR_x"])
 
-    scene_span_x = scene_right - scene_left
-    scene_span_y = scene_bottom - scene_top
+    return [scene_left, scene_top, scene_right - scene_left, scene_bottom - scene_top]
+
+def compute_tile_coords(row, col, width, height, config, extent=None):
+    [scene_left, scene_top, scene_span_x, scene_span_y] = extent or scene_extent(config)
 
     left = scene_left + ((col * config.GRID_SIZE) / config.width) * scene_span_x
     top = scene_top + ((row * config.GRID_SIZE) / config.height) * scene_span_y
@@ -26,30 +40,40 @@ def compute_tile_coords(row, col, width, height, config):
 
     return [left, top, right, bottom]
 
-def compute_coordinate_metadata(row, col, width, height, config):
-    [left, top, right, bottom] = compute_tile_coords(row, col, width, height, config)
-    tile_center_x = (left+right)/2
-    tile_center_y = (top+bottom)/2
-
-    [lon, lat] = compute_lat_lon(tile_center_x, tile_center_y, config.METADATA['#utm_zone'])
-
-    return {
-        '#tile_UL_x': left,
-        '#tile_UL_y': top,
-        '#tile_UR_x': right,
-        '#tile_UR_y': top,
-        '#tile_LL_x': left,
-        '#tile_LL_y': bottom,
-        '#tile_LR_x': right,
-        '#tile_LR_y': bottom,
-
-        '#tile_center_x': tile_center_x,
-        '#tile_center_y': tile_center_y,
-
-        'center_lat': lat,
-        'center_lon': lon,
-        'map_link': generate_map_link(lat, lon)
-    }
+def compute_tiles_coordinate_metadata(tiles, config):
+    # tiles are [row, col, width, height], all projected with one transform
+    extent = scene_extent(config)
+    corners = [
+        compute_tile_coords(row, col, width, height, config, extent)
+        for [row, col, width, height] in tiles]
+
+    centers_x = [(left+right)/2 for [left, top, right, bottom] in corners]
+    centers_y = [(top+bottom)/2 for [left, top, right, bottom] in corners]
+
+    [lons, lats] = compute_lat_lon(centers_x, centers_y, config.METADATA['#utm_zone'])
+
+    accum = []
+    for [left, top, right, bottom], center_x, center_y, lat, lon in zip(
+            corners, centers_x, centers_y, lats, lons):
+        accum.append({
+            '#tile_UL_x': left,
+            '#tile_UL_y': top,
+            '#tile_UR_x': right,
+            '#tile_UR_y': top,
+            '#tile_LL_x': left,
+            '#tile_LL_y': bottom,
+            '#tile_LR_x': right,
+            '#tile_LR_y': bottom,
+
+            '#tile_center_x': center_x,
+            '#tile_center_y': center_y,
+
+            'center_lat': lat,
+            'center_lon': lon,
+            'map_link': generate_map_link(lat, lon)
+        })
+
+    return accum
 
 
 def generate_map_link(lat, lon):
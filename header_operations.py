@@ -0,0 +1,64 @@
+import struct
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+
+# tiff field types that can hold a dimension, with their size and format
+TIFF_TYPES = {3: [2, "H"], 4: [4, "I"], 16: [8, "Q"]}
+
+def png_dimensions(image_file):
+    header = image_file.read(24)
+    if header[:8] != PNG_SIGNATURE or header[12:16] != b"IHDR":
+        return None
+    return list(struct.unpack(">II", header[16:24]))
+
+def tiff_dimensions(image_file):
+    header = image_file.read(16)
+    order = {b"II": "<", b"MM": ">"}.get(header[:2])
+    if order is None:
+        return None
+
+    [version] = struct.unpack(order + "H", header[2:4])
+    if version == 42:
+        [offset] = struct.unpack(order + "I", header[4:8])
+        [count_format, entry_size, value_size] = ["H", 12, 4]
+    elif version == 43:
+        # BigTIFF, as written for scenes over 4GB
+        [offset] = struct.unpack(order + "Q", header[8:16])
+        [count_format, entry_size, value_size] = ["Q", 20, 8]
+    else:
+        return None
+
+    image_file.seek(offset)
+    count_size = struct.calcsize(count_format)
+    [count] = struct.unpack(order + count_format, image_file.read(count_size))
+    entries = image_file.read(count * entry_size)
+
+    dimensions = {}
+    for position in range(0, len(entries) - entry_size + 1, entry_size):
+        [tag, field_type] = struct.unpack(order + "HH", entries[position:position + 4])
+        if tag in (IMAGE_WIDTH, IMAGE_LENGTH) and field_type in TIFF_TYPES:
+            [size, value_format] = TIFF_TYPES[field_type]
+            start = position + entry_size - value_size
+            [dimensions[tag]] = struct.unpack(
+                order + value_format, entries[start:start + size])
+
+    if IMAGE_WIDTH not in dimensions or IMAGE_LENGTH not in dimensions:
+        return None
+    return [dimensions[IMAGE_WIDTH], dimensions[IMAGE_LENGTH]]
+
+def read_dimensions(a_file):
+    # [width, height] from the file header alone, None when it is not png or tiff
+    with open(a_file, 'rb') as image_file:
+        for reader in [png_dimensions, tiff_dimensions]:
+            image_file.seek(0)
+            try:
+                dimensions = reader(image_file)
+            except struct.error:
+                # truncated header
+                continue
+            if dimensions is not None:
+                return dimensions
+    return None
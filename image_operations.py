@@ -1,8 +1,42 @@
 import logging
-from os import path
-from subprocess import check_output, call
+from os import path, wait4, WIFSIGNALED, WTERMSIG, WEXITSTATUS
+import subprocess
+
+from file_operations import get_files_by_extension
+from metrics_operations import count_subprocess
+from header_operations import read_dimensions
+from tile_operations import tile_index, tile_location, tile_box, tile_outputs
+
+# tiles written by one convert, each adds ~10 arguments and argv is limited
+TILES_PER_CALL = 500
+
+def run(args, stdout=None):
+    # [returncode, output], wait4 reports the peak memory of this one child
+    process = subprocess.Popen(args, stdout=stdout)
+    output = None
+    if stdout:
+        output = process.stdout.read()
+        process.stdout.close()
+    [_, status, usage] = wait4(process.pid, 0)
+    process.returncode = -WTERMSIG(status) if WIFSIGNALED(status) else WEXITSTATUS(status)
+    count_subprocess(usage.ru_maxrss)
+    return [process.returncode, output]
+
+def call(args):
+    return run(args)[0]
+
+def check_output(args):
+    [returncode, output] = run(args, subprocess.PIPE)
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, args, output)
+    return output
 
 def get_dimensions(a_file):
+    # png and tiff headers are read in process, anything else asks convert
+    dimensions = read_dimensions(a_file)
+    if dimensions is not None:
+        return dimensions
+
     result = check_output([
         "convert",
         "-quiet",
@@ -16,35 +50,16 @@ def get_dimensions(a_file):
     return [int(result[0].strip()), int(result[1].strip())]
 
 def get_height(a_file):
-    return int(check_output([
-        "convert",
-        "-quiet",
-        a_file,
-        "-ping",
-        "-format",
-        '%[fx:h]',
-        "info:"
-    ]).strip())
+    return get_dimensions(a_file)[1]
 
 def get_width(a_file):
-    return int(check_output([
-        "convert",
-        "-quiet",
-        a_file,
-        "-ping",
-        "-format",
-        '%[fx:w]',
-        "info:"
-    ]).strip())
+    return get_dimensions(a_file)[0]
 
 def generate_rectangles(tiles, width, grid_size):
     rects = []
-    per_row = width // grid_size + 1
 
     for elem in tiles:
-        idx = int(elem.split("_")[1].split(".")[0])
-        row = idx // per_row
-        col = idx % per_row
+        [row, col] = tile_location(tile_index(elem), width, grid_size)
 
         rects.append("-draw")
         rects.append("rectangle " +
@@ -115,19 +130,48 @@ def get_image_statistics(image):
         "info:"
     ]).strip('"').split(" ")]
 
+def get_mask_tiles(config):
+    return get_files_by_extension(path.join(config.SCRATCH_PATH, "land"), "png")
+
+def get_tile_statistics(config, subdirectory, filenames):
+    statistics = {}
+    for filename in filenames:
+        statistics[tile_index(filename)] = get_image_statistics(path.join(
+            config.SCRATCH_PATH,
+            subdirectory,
+            filename))
+    return statistics
+
 def draw_visualization(land, clouds, water, config):
-    args = \
-        ["convert", "-quiet", config.INPUT_FILE, "-strokewidth", "0"] \
-        + ["-fill", "rgba(0,255,0,0.5)"] \
-        + land \
-        + ["-fill", "rgba(255,255,255,0.5)"] \
-        + clouds \
-        + ["-fill", "rgba(0,0,255,0.5)"] \
-        + water \
-        + ["-alpha", "remove"] \
-        + ["-resize", "1000x1000", config.SCENE_NAME + "_tiles/visualize.png"]
-
-    call(args)
+    # [fill, "-draw", rectangle] of every tile, painted in this order
+    draws = []
+    for [fill, rects] in [
+            ["rgba(0,255,0,0.5)", land],
+            ["rgba(255,255,255,0.5)", clouds],
+            ["rgba(0,0,255,0.5)", water]]:
+        for first in range(0, len(rects), 2):
+            draws.append([fill] + rects[first:first + 2])
+
+    # argv is limited, a big scene is painted a chunk of tiles per convert,
+    # each reading what the last one left in a lossless miff
+    partial = path.join(config.SCRATCH_PATH, "visualize.miff")
+    source = config.INPUT_FILE
+    for first in range(0, len(draws), TILES_PER_CALL):
+        args = ["convert", "-quiet", source, "-strokewidth", "0"]
+        fill = None
+        for draw in draws[first:first + TILES_PER_CALL]:
+            if draw[0] != fill:
+                fill = draw[0]
+                args += ["-fill", fill]
+            args += draw[1:]
+
+        call(args + [partial])
+        source = partial
+
+    call([
+        "convert", "-quiet", source, "-alpha", "remove",
+        "-resize", "1000x1000", config.SCENE_NAME + "_tiles/visualize.png"
+    ])
 
 def clamp_image(source, dest, config, brighten):
     logger = logging.getLogger(config.SCENE_NAME)
@@ -143,6 +187,10 @@ def boost_image(source, config):
 def _clamp_image(source, dest, config, boost, brighten):
     lut = ("clamp_lut.pgm" if boost else "boost_lut.pgm")
 
+    if config.COLOR_CURVE or config.BOOST_CHANNEL_CURVE:
+        from lut_operations import curve_file
+        lut = curve_file(lut, config)
+
     new_args = [
         "convert",
         "-quiet",
@@ -260,18 +308,53 @@ def assemble_image(config):
 
     logger.info("Compositing red, green, and blue images")
     call(assemble_args)
+    publish_render(config)
+
+def publish_render(config):
     call([
         "cp",
         path.join(config.SCRATCH_PATH, "render.png"),
         config.SCENE_NAME + "_tiles/render.png"
     ])
 
+def png_options(config):
+    return ["-define", "png:compression-level=" + str(config.PNG_COMPRESSION)]
+
 def prepare_tiles(config):
-    call([
+    args = [
         "convert",
         "-quiet",
         path.join(config.SCRATCH_PATH, "render.png"),
         "-crop",
-        str(config.GRID_SIZE)+"x"+str(config.GRID_SIZE),
+        str(config.GRID_SIZE)+"x"+str(config.GRID_SIZE)
+    ]
+    if config.TILE_SIZE:
+        args += ["-resize", "{0}x{0}".format(config.TILE_SIZE)]
+
+    call(args + png_options(config) + [
         path.join(config.SCRATCH_PATH, "scene", "tile_%04d.png")
     ])
+
+def write_sorted_tiles(config, accepted, rejected):
+    # each convert decodes the render once and writes a chunk of tiles from clones
+    tiles_dir = "{0}_tiles".format(config.SCENE_NAME)
+    tiles = [
+        [filename, destination, size]
+        for [filenames, destination, size] in tile_outputs(config, accepted, rejected)
+        for filename in filenames]
+
+    for first in range(0, len(tiles), TILES_PER_CALL):
+        args = ["convert", "-quiet", path.join(config.SCRATCH_PATH, "render.png")]
+        args += png_options(config)
+
+        for [filename, destination, size] in tiles[first:first + TILES_PER_CALL]:
+            [left, top, width, height] = tile_box(
+                tile_index(filename), config.width, config.height, config.GRID_SIZE)
+            args += [
+                "(", "+clone",
+                "-crop", "{0}x{1}+{2}+{3}".format(width, height, left, top), "+repage"]
+            if size:
+                args += ["-resize", "{0}x{0}".format(size)]
+            args += ["-write", path.join(tiles_dir, destination, filename), "+delete", ")"]
+
+        call(args + ["null:"])
@@ -0,0 +1,95 @@
+from os import path
+from time import time
+import hashlib
+import json
+import sqlite3
+
+# scene states a resumed batch does not run again
+FINISHED = ['success', 'triaged', 'skipped']
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS scenes (
+        scene TEXT PRIMARY KEY,
+        status TEXT NOT NULL,
+        updated REAL NOT NULL,
+        seconds REAL,
+        error TEXT,
+        output TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS stages (
+        scene TEXT NOT NULL,
+        stage TEXT NOT NULL,
+        key TEXT NOT NULL,
+        outputs TEXT NOT NULL,
+        finished REAL NOT NULL,
+        PRIMARY KEY (scene, stage)
+    )"""
+]
+
+def connect(ledger):
+    # every worker process opens its own connection, sqlite serializes writers
+    connection = sqlite3.connect(ledger, timeout=60)
+    for statement in SCHEMA:
+        connection.execute(statement)
+    return connection
+
+def _execute(ledger, statement, parameters=()):
+    connection = connect(ledger)
+    try:
+        with connection:
+            return connection.execute(statement, parameters).fetchall()
+    finally:
+        connection.close()
+
+def scene_id(scene_dir):
+    return path.abspath(scene_dir)
+
+def mark_scene(ledger, scene_dir, status, seconds=None, error='', output=''):
+    _execute(
+        ledger,
+        "INSERT OR REPLACE INTO scenes (scene, status, updated, seconds, error, output) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (scene_id(scene_dir), status, time(), seconds, error, output))
+
+def finished_scenes(ledger):
+    # {scene: status} of scenes done with, a processed scene's output must remain
+    if not path.exists(ledger):
+        return {}
+
+    finished = {}
+    for [scene, status, output] in _execute(ledger, "SELECT scene, status, output FROM scenes"):
+        if status == 'skipped' or (status in FINISHED and output and path.isdir(output)):
+            finished[scene] = status
+    return finished
+
+def file_checksum(a_file):
+    digest = hashlib.sha1()
+    with open(a_file, 'rb') as contents:
+        for block in iter(lambda: contents.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def complete_stage(ledger, scene_dir, name, key, outputs):
+    checksums = [[path.abspath(a_file), file_checksum(a_file)] for a_file in outputs]
+    _execute(
+        ledger,
+        "INSERT OR REPLACE INTO stages (scene, stage, key, outputs, finished) "
+        "VALUES (?, ?, ?, ?, ?)",
+        (scene_id(scene_dir), name, key, json.dumps(checksums), time()))
+
+def stage_complete(ledger, scene_dir, name, key):
+    # only when every output is still on disk exactly as the stage left it
+    rows = _execute(
+        ledger,
+        "SELECT key, outputs FROM stages WHERE scene = ? AND stage = ?",
+        (scene_id(scene_dir), name))
+    if not rows or rows[0][0] != key:
+        return False
+
+    for [a_file, checksum] in json.loads(rows[0][1]):
+        if not path.exists(a_file) or file_checksum(a_file) != checksum:
+            return False
+    return True
+
+def forget_scene(ledger, scene_dir):
+    _execute(ledger, "DELETE FROM stages WHERE scene = ?", (scene_id(scene_dir),))
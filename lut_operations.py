@@ -0,0 +1,184 @@
+from os import path, rename, getpid
+from sys import argv
+import threading
+
+import numpy as np
+
+QUANTUM_RANGE = 65535
+
+LUT_FILES = ["water_lut.pgm", "cloud_lut.pgm", "snow_lut.pgm", "clamp_lut.pgm", "boost_lut.pgm"]
+
+LUTS = {}
+GENERATED = {}
+WRITTEN = {}
+LOCK = threading.Lock()
+
+# the sigmoid curves formerly produced by lut_builder.rb, by the LUT they replace
+CURVES = {
+    "clamp_lut.pgm": {'boost_amount': 0},
+    "boost_lut.pgm": {'boost_amount': 400}
+}
+
+# the LUT names are swapped, boost_image applies clamp_lut.pgm and the red,
+# green and blue channels boost_lut.pgm, so the settings follow the channels
+CURVE_CONFIG = {
+    "clamp_lut.pgm": 'BOOST_CHANNEL_CURVE',
+    "boost_lut.pgm": 'COLOR_CURVE'
+}
+
+CURVE_DEFAULTS = {
+    'lowpass': 345,
+    'boost_amount': 0,
+    'boost_end': 1100,
+    'cutoff': 16000,
+    'sentinel': 20000,
+    'amplitude': 65535.0,
+    'sharpness': 2048.0
+}
+
+CURVE_PARAMETERS = [
+    'lowpass', 'boost_amount', 'boost_end', 'cutoff', 'sentinel', 'amplitude', 'sharpness']
+
+def _header(data):
+    # reads the magic number, width, height and maxval, skipping comments
+    tokens = []
+    position = 0
+    while len(tokens) < 4:
+        while data[position:position + 1].isspace():
+            position += 1
+        if data[position:position + 1] == b"#":
+            position = data.index(b"\n", position)
+            continue
+        start = position
+        while not data[position:position + 1].isspace():
+            position += 1
+        tokens.append(data[start:position].decode("ascii"))
+
+    # exactly one whitespace character separates the header from the raster
+    return [tokens, position + 1]
+
+def parse_pgm(which_lut):
+    with open(which_lut, "rb") as lut_file:
+        data = lut_file.read()
+
+    [[magic, width, height, maxval], position] = _header(data)
+    count = int(width) * int(height)
+    maxval = int(maxval)
+
+    if magic == "P5":
+        dtype = ">u2" if maxval > 255 else "u1"
+        values = np.frombuffer(data, dtype=dtype, count=count, offset=position)
+    else:
+        values = np.array([
+            int(token) for token in
+            b" ".join(line.split(b"#")[0] for line in data[position:].splitlines()).split()[:count]
+        ])
+
+    values = values.astype(np.float64)
+    return np.rint(values * QUANTUM_RANGE / maxval).astype(np.uint16)
+
+def cache_filename(which_lut):
+    return path.splitext(which_lut)[0] + ".npy"
+
+def _read_lut(which_lut, binary_cache):
+    cached = cache_filename(which_lut)
+
+    if binary_cache and path.exists(cached) and \
+            path.getmtime(cached) >= path.getmtime(which_lut):
+        return np.load(cached)
+
+    lut = parse_pgm(which_lut)
+
+    if binary_cache:
+        # workers may race to build the cache, only ever rename complete files
+        partial = "{0}.{1}.tmp.npy".format(path.splitext(cached)[0], getpid())
+        np.save(partial, lut)
+        rename(partial, cached)
+
+    return lut
+
+def load_lut(which_lut, binary_cache=False):
+    with LOCK:
+        if which_lut not in LUTS:
+            LUTS[which_lut] = _read_lut(which_lut, binary_cache)
+        return LUTS[which_lut]
+
+def apply_lut(lut, band):
+    # a 65536 entry table maps every 16 bit value directly, like -clut does
+    return lut[band]
+
+def parse_curve(value):
+    # "lowpass=300,boost_end=1000" as given on the command line
+    overrides = {}
+    for pair in value.split(","):
+        [key, number] = pair.split("=")
+        if key not in CURVE_DEFAULTS:
+            raise ValueError("Unknown curve parameter " + key)
+        overrides[key] = float(number)
+    return overrides
+
+def curve_overrides(which_lut, config):
+    if which_lut not in CURVE_CONFIG:
+        return {}
+    return getattr(config, CURVE_CONFIG[which_lut])
+
+def curve_parameters(which_lut, overrides):
+    parameters = dict(CURVE_DEFAULTS)
+    parameters.update(CURVES[which_lut])
+    parameters.update(overrides)
+    return tuple(parameters[key] for key in CURVE_PARAMETERS)
+
+def generate_lut(lowpass, boost_amount, boost_end, cutoff, sentinel, amplitude, sharpness):
+    key = (lowpass, boost_amount, boost_end, cutoff, sentinel, amplitude, sharpness)
+
+    with LOCK:
+        if key not in GENERATED:
+            values = np.arange(QUANTUM_RANGE + 1, dtype=np.float64)
+            shifted = np.where(values < boost_end, values + boost_amount, values)
+
+            lut = np.floor(amplitude * (1.0 - 1.0 / (1.0 + shifted / sharpness)))
+            lut[values < lowpass] = 0
+            lut[values > cutoff] = 0
+            lut[(values > cutoff) & (values == sentinel)] = QUANTUM_RANGE
+
+            GENERATED[key] = np.clip(lut, 0, QUANTUM_RANGE).astype(np.uint16)
+        return GENERATED[key]
+
+def lut_for(which_lut, config):
+    if which_lut in CURVES:
+        return generate_lut(*curve_parameters(which_lut, curve_overrides(which_lut, config)))
+    return load_lut(which_lut, config.LUT_CACHE)
+
+def preload_luts(binary_cache):
+    for which_lut in LUT_FILES:
+        if which_lut in CURVES:
+            generate_lut(*curve_parameters(which_lut, {}))
+        else:
+            load_lut(which_lut, binary_cache)
+
+def write_pgm(lut, filename):
+    with open(filename, "wb") as lut_file:
+        lut_file.write("P5\n{0} 1\n{1}\n".format(len(lut), QUANTUM_RANGE).encode("ascii"))
+        lut_file.write(lut.astype(">u2").tobytes())
+
+def curve_file(which_lut, config):
+    # convert needs the tuned curve on disk, write it once per scratch directory
+    target = path.join(config.SCRATCH_PATH, which_lut)
+    parameters = curve_parameters(which_lut, curve_overrides(which_lut, config))
+    lut = generate_lut(*parameters)
+
+    with LOCK:
+        if WRITTEN.get(target) != parameters:
+            write_pgm(lut, target)
+            WRITTEN[target] = parameters
+
+    return target
+
+def main():
+    # python lut_operations.py boost_lut.pgm [lowpass=345,boost_end=1100,...]
+    which_lut = argv[1]
+    overrides = parse_curve(argv[2]) if len(argv) > 2 else {}
+    write_pgm(generate_lut(*curve_parameters(which_lut, overrides)), which_lut)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+from __future__ import division
+from contextlib import contextmanager
+from os import path, walk, times
+from timeit import default_timer
+import json
+import resource
+import threading
+
+LOCK = threading.Lock()
+SUBPROCESSES = [0]
+
+# how often a measured stage samples the resident memory of the process
+RSS_SAMPLE_SECONDS = 0.01
+PAGE_KB = resource.getpagesize() // 1024
+
+# {'rss_kb': .., 'child_rss_kb': ..} of every stage being measured
+ACTIVE = []
+
+def count_subprocess(peak_rss_kb=0):
+    with LOCK:
+        SUBPROCESSES[0] += 1
+        for peaks in ACTIVE:
+            peaks['child_rss_kb'] = max(peaks['child_rss_kb'], peak_rss_kb)
+
+def rss_kb():
+    # resident memory now, ru_maxrss is the peak of the whole process lifetime
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * PAGE_KB
+    except (IOError, OSError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def _sample_rss(peaks, done):
+    while True:
+        rss = rss_kb()
+        with LOCK:
+            peaks['rss_kb'] = max(peaks['rss_kb'], rss)
+        if done.wait(RSS_SAMPLE_SECONDS):
+            return
+
+def directory_size(directory):
+    total = 0
+    for root, _, files in walk(directory):
+        for filename in files:
+            try:
+                total += path.getsize(path.join(root, filename))
+            except OSError:
+                continue
+    return total
+
+def _snapshot(config):
+    cpu = times()
+    return {
+        'wall': default_timer(),
+        'cpu': cpu[0] + cpu[1],
+        'child_cpu': cpu[2] + cpu[3],
+        'subprocesses': SUBPROCESSES[0],
+        'scratch_size': directory_size(config.SCRATCH_PATH)
+    }
+
+def _stage_metrics(config):
+    with LOCK:
+        if not hasattr(config, 'STAGE_METRICS'):
+            config.STAGE_METRICS = []
+        return config.STAGE_METRICS
+
+@contextmanager
+def measure(name, config):
+    if not config.METRICS:
+        yield
+        return
+
+    # cpu, memory, subprocesses and scratch are process wide, so stages
+    # running side by side with --jobs each see the work of the others
+    peaks = {'rss_kb': 0, 'child_rss_kb': 0}
+    done = threading.Event()
+    sampler = threading.Thread(target=_sample_rss, args=(peaks, done))
+    sampler.daemon = True
+
+    with LOCK:
+        ACTIVE.append(peaks)
+    before = _snapshot(config)
+    sampler.start()
+    try:
+        yield
+    finally:
+        done.set()
+        sampler.join()
+        with LOCK:
+            ACTIVE.remove(peaks)
+    after = _snapshot(config)
+
+    _stage_metrics(config).append({
+        'stage': name,
+        'wall_seconds': after['wall'] - before['wall'],
+        'cpu_seconds': after['cpu'] - before['cpu'],
+        'child_cpu_seconds': after['child_cpu'] - before['child_cpu'],
+        'peak_rss_kb': max(peaks['rss_kb'], rss_kb()),
+        'peak_child_rss_kb': peaks['child_rss_kb'],
+        'subprocesses': after['subprocesses'] - before['subprocesses'],
+        'scratch_growth_bytes': after['scratch_size'] - before['scratch_size']
+    })
+
+def write_metrics(filename, config):
+    report = {
+        'scene': config.SCENE_NAME,
+        'engine': config.ENGINE,
+        'width': config.width,
+        'height': config.height,
+        'grid_size': config.GRID_SIZE,
+        'stages': _stage_metrics(config)
+    }
+
+    with open(filename, 'w') as metrics_file:
+        json.dump(report, metrics_file, indent=2, sort_keys=True)
+
+def aggregate_metrics(reports):
+    stages = {}
+
+    for report in reports:
+        for record in report['stages']:
+            summary = stages.setdefault(record['stage'], {
+                'scenes': 0,
+                'wall_seconds': 0.0,
+                'max_wall_seconds': 0.0,
+                'cpu_seconds': 0.0,
+                'child_cpu_seconds': 0.0,
+                'peak_rss_kb': 0,
+                'peak_child_rss_kb': 0,
+                'subprocesses': 0,
+                'scratch_growth_bytes': 0
+            })
+            summary['scenes'] += 1
+            summary['wall_seconds'] += record['wall_seconds']
+            summary['max_wall_seconds'] = max(summary['max_wall_seconds'], record['wall_seconds'])
+            summary['cpu_seconds'] += record['cpu_seconds']
+            summary['child_cpu_seconds'] += record['child_cpu_seconds']
+            summary['peak_rss_kb'] = max(summary['peak_rss_kb'], record['peak_rss_kb'])
+            summary['peak_child_rss_kb'] = max(
+                summary['peak_child_rss_kb'], record['peak_child_rss_kb'])
+            summary['subprocesses'] += record['subprocesses']
+            summary['scratch_growth_bytes'] += record['scratch_growth_bytes']
+
+    for summary in stages.values():
+        summary['mean_wall_seconds'] = summary['wall_seconds'] / summary['scenes']
+
+    return {'scenes': len(reports), 'stages': stages}
@@ -0,0 +1,57 @@
+from tile_operations import tile_index
+
+SETTINGS = ['LAND_THRESHHOLD', 'LAND_SENSITIVITY', 'CLOUD_THRESHHOLD', 'CLOUD_SENSITIVITY']
+
+def cloud_rules(threshold, sensitivity):
+    return [
+        lambda imin, imax, imean, idev: float(imin) < threshold,
+        lambda imin, imax, imean, idev: (
+            float(imean) < threshold or
+            float(idev) > sensitivity
+        )
+    ]
+
+def land_rules(threshold, sensitivity):
+    return [
+        lambda imin, imax, imean, idev: float(imax) > threshold,
+        lambda imin, imax, imean, idev: (
+            float(imean) > threshold or
+            float(idev) > sensitivity
+        )
+    ]
+
+def filter_tiles(candidates, rejects, statistics, rules):
+    accum = []
+
+    for filename in candidates:
+        done = False
+        for rule in rules:
+            if not rule(*statistics[tile_index(filename)]):
+                rejects.append(filename)
+                done = True
+                break
+        if done:
+            continue
+
+        accum.append(filename)
+
+    return accum
+
+def rule_settings(config):
+    return dict((name, getattr(config, name)) for name in SETTINGS)
+
+def sort_tiles(candidates, statistics, settings, remove_clouds=True, remove_land=True):
+    # the same order as simple.py: clouds first, then land on what is left
+    no_water = []
+    too_cloudy = []
+    retained = candidates
+
+    if remove_clouds:
+        retained = filter_tiles(retained, too_cloudy, statistics['cloud'], cloud_rules(
+            settings['CLOUD_THRESHHOLD'], settings['CLOUD_SENSITIVITY']))
+
+    if remove_land:
+        retained = filter_tiles(retained, no_water, statistics['land'], land_rules(
+            settings['LAND_THRESHHOLD'], settings['LAND_SENSITIVITY']))
+
+    return [retained, no_water, too_cloudy]
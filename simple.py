@@ -1,16 +1,26 @@
 from os import path
 from sys import argv
+import json
 import logging
 
 import image_operations as img
-from csv_operations import write_rejects, write_manifest
+from csv_operations import (
+    write_rows, append_rows, manifest_schema, rejects_schema, write_tile_statistics)
 
 from file_operations import (
     build_output, scratch_exists,
-    build_scratch, get_files_by_extension, accept_tile, reject_tile,
+    build_scratch, get_files_by_extension, place_tiles,
     maybe_clean_scratch, find_scene_name)
-from gis_operations import compute_coordinate_metadata
-from xml_operations import parse_metadata
+from cache_operations import cached
+from columnar_operations import write_columnar
+from gis_operations import compute_tiles_coordinate_metadata
+from ledger_operations import finished_scenes, scene_id
+from metrics_operations import measure, write_metrics
+from rules_operations import cloud_rules, land_rules, filter_tiles
+from stage_operations import stage, run_stages
+from tile_operations import tile_geometry
+from triage_operations import triage_scene
+from xml_operations import parse_metadata, METADATA_KEYS
 from config import config
 
 logging.basicConfig(
@@ -20,6 +30,19 @@ logging.basicConfig(
 LANDSAT = {'red': 'band5', 'green': 'band2', 'blue': 'band3', 'infrared': 'band4'}
 LANDSAT8 = {'red': 'band6', 'green': 'band3', 'blue': 'band4', 'infrared': 'band5'}
 
+CSV_CHUNK = 1024
+
+# options that make main do anything at all, without one it prints usage
+ACTIONS = [
+    "--full", "--clean", "--generate", "--assemble", "--generate-tiles", "--sort-tiles",
+    "--generate-mask", "--reject", "--visualize", "--manifest"]
+
+def with_action(options):
+    # options for main, running the full pipeline unless they name an action
+    if [option for option in options if option in ACTIONS]:
+        return options
+    return options + ["--full"]
+
 def usage():
     print """
 simple.py (Simple Image Pipeline)
@@ -51,8 +74,27 @@ channel to aid in kelp-spotting.
 
     --manifest              Build a manifest file for Panoptes subject upload
 
+    --combined-manifest=MY_FILE
+                            Also append accepted tiles to a manifest shared
+                            by many scenes, safe for parallel batch.py workers
+
+    --columnar=MY_PATH      Also write a typed per-tile table (npz) and the
+                            scene metadata (json) once, to MY_PATH/scene=NAME
+
+    --metadata-index=MY_FILE
+                            Take scene metadata from an index built by
+                            batch.py when it is current for the scene
+
+    --triage                Before any image work, estimate from the metadata
+                            and a decimated pixel_qa read how many tiles will
+                            be accepted, and stop early for hopeless scenes
+    --triage-min-tiles=N    Fewest estimated tiles worth processing (default 1)
+    --triage-step=N         Read every Nth pixel of pixel_qa (default 8)
+
     --grid-size=XXX         Set custom tile size
 
+    --scratch-path=MY_PATH  Keep intermediate files in a specified directory
+
     --source-dir=MY_PATH    Load scenes from a specified directory
 
     --land-threshhold=XX    Configure land detection
@@ -60,12 +102,87 @@ channel to aid in kelp-spotting.
 
     --cloud-threshhold=XX   Configure cloud detection
     --cloud-sensitivity=XX
+
+    --save-statistics       Measure every mask tile and keep the figures in
+                            SCENE_tiles/tile_statistics.csv for tune.py
+
+    --write-kept-only       Sort tiles before any scene tile is written, then
+                            write each kept tile once, at its final size
+                            (with --reject, otherwise every tile is sliced)
+    --tile-size=XXX         Size the written tiles are fitted to (default is
+                            the grid size, as cropped)
+    --rejected-tiles=HOW    Write rejected tiles in "full" (default), as a
+                            "thumbnail", or "none" at all
+    --thumbnail-size=XXX    Size of rejected thumbnails (default 100)
+    --png-compression=N     zlib level of written tiles, from 0 (fastest) to 9
+                            (smallest, default 6)
+    --tile-workers=N        Tiles encoded at once with the numpy engine
+                            (default 4), the convert engine slices tiles in
+                            serial convert calls and ignores it
+
+    --placement=HOW         Put sorted tiles in place by "hardlink", "reflink",
+                            "move" or "copy", falling back to a copy when the
+                            filesystem refuses (default "auto" tries the
+                            cheapest first, moving only out of a temporary
+                            scratch directory)
+    --placement-workers=N   Tiles placed at once (default 4)
+
+    --cache                 Skip mask, color, slicing and mask tile stages
+                            whose inputs, settings and code are unchanged
+                            since they last ran in this scratch directory
+    --resume                Keep the scratch directory, skip every stage
+                            --cache would, and remove the scratch directory
+                            once the scene is done. SCENE_tiles is rebuilt
+                            unless the --ledger records the scene as finished
+    --ledger=MY_FILE        Record finished stages with the checksums of their
+                            outputs in the SQLite ledger MY_FILE, and only skip
+                            a stage whose outputs still match (implies --cache)
+
+    --metrics               Record time, cpu, memory, subprocesses and scratch
+                            bytes of every stage in SCENE_tiles/metrics.json:
+                            peak_rss_kb is the highest resident memory sampled
+                            every 10ms during the stage, peak_child_rss_kb the
+                            peak of its largest subprocess, and
+                            scratch_growth_bytes how much the scratch
+                            directory grew (files removed count against it)
+
+    --engine=ENGINE         Image processing engine, either "convert" (default)
+                            or "numpy" to process bands in memory, which
+                            rounds colour channels to 8 bits uniformly where
+                            convert quantizes them with -colors 256, so they
+                            can differ slightly (see compare_engines.py)
+    --virtual-tiles         Sort tiles straight from the in-memory masks
+                            without writing mask tiles (numpy engine only)
+
+    --stream                Process the scene in horizontal strips so memory
+                            stays bounded, writing each strip's tiles as soon
+                            as it is done (numpy engine only, no visualization,
+                            and SCENE_tiles/render.png is a preview of at most
+                            1000px rather than the full render)
+    --strip-tiles=N         Rows of tiles per streamed strip (default 1)
+
+    --jobs=N                Run up to N independent mask and color stages
+                            of a scene at the same time
+
+    --scratch-format=FMT    Keep intermediates as "png" (default) or as raw
+                            memory-mapped "npy" arrays (numpy engine only)
+
+    --lut-cache             Keep a binary .npy copy of each LUT next to the
+                            .pgm file and load that instead (numpy engine only)
+
+    --color-curve=K=V,...   Tune the curve of the red, green and blue channels
+                            (generated in place of boost_lut.pgm)
+    --boost-channel-curve=K=V,...
+                            Tune the curve of the boost channel (generated in
+                            place of clamp_lut.pgm), both with any of lowpass,
+                            boost_amount, boost_end, cutoff, sentinel,
+                            amplitude and sharpness
     """
 
 
-def parse_options():
+def parse_options(args):
     # note that logger is undefined when this method is active
-    for arg in argv:
+    for arg in args:
         if arg == "simple.py":
             continue
 
@@ -117,6 +234,18 @@ def parse_options():
         elif arg == "--manifest":
             config.BUILD_MANIFEST = True
 
+        elif arg.startswith("--combined-manifest="):
+            config.COMBINED_MANIFEST = arg.split("=")[1]
+        elif arg.startswith("--columnar="):
+            config.COLUMNAR_PATH = arg.split("=")[1]
+        elif arg.startswith("--metadata-index="):
+            config.METADATA_INDEX = arg.split("=")[1]
+        elif arg == "--triage":
+            config.TRIAGE = True
+        elif arg.startswith("--triage-min-tiles="):
+            config.TRIAGE_MIN_TILES = int(arg.split("=")[1])
+        elif arg.startswith("--triage-step="):
+            config.TRIAGE_STEP = int(arg.split("=")[1])
         elif arg.startswith("--grid-size="):
             config.GRID_SIZE = int(arg.split("=")[1])
         elif arg.startswith("--land-threshhold="):
@@ -127,6 +256,54 @@ def parse_options():
             config.CLOUD_THRESHHOLD = int(arg.split("=")[1])
         elif arg.startswith("--cloud-sensitivity="):
             config.CLOUD_SENSITIVITY = int(arg.split("=")[1])
+        elif arg.startswith("--scratch-path="):
+            config.SCRATCH_PATH = arg.split("=")[1]
+        elif arg.startswith("--engine="):
+            config.ENGINE = arg.split("=")[1]
+        elif arg == "--virtual-tiles":
+            config.VIRTUAL_TILES = True
+        elif arg == "--stream":
+            config.STREAM = True
+        elif arg.startswith("--strip-tiles="):
+            config.STRIP_TILES = int(arg.split("=")[1])
+        elif arg == "--save-statistics":
+            config.SAVE_STATISTICS = True
+        elif arg == "--write-kept-only":
+            config.WRITE_KEPT_ONLY = True
+        elif arg.startswith("--tile-size="):
+            config.TILE_SIZE = int(arg.split("=")[1])
+        elif arg.startswith("--rejected-tiles="):
+            config.REJECTED_TILES = arg.split("=")[1]
+        elif arg.startswith("--thumbnail-size="):
+            config.THUMBNAIL_SIZE = int(arg.split("=")[1])
+        elif arg.startswith("--png-compression="):
+            config.PNG_COMPRESSION = int(arg.split("=")[1])
+        elif arg.startswith("--tile-workers="):
+            config.TILE_WORKERS = int(arg.split("=")[1])
+        elif arg.startswith("--placement="):
+            config.PLACEMENT = arg.split("=")[1]
+        elif arg.startswith("--placement-workers="):
+            config.PLACEMENT_WORKERS = int(arg.split("=")[1])
+        elif arg == "--cache":
+            config.STAGE_CACHE = True
+        elif arg == "--resume":
+            config.RESUME = True
+        elif arg.startswith("--ledger="):
+            config.LEDGER = arg.split("=")[1]
+        elif arg == "--metrics":
+            config.METRICS = True
+        elif arg.startswith("--jobs="):
+            config.STAGE_WORKERS = int(arg.split("=")[1])
+        elif arg.startswith("--scratch-format="):
+            config.SCRATCH_FORMAT = arg.split("=")[1]
+        elif arg == "--lut-cache":
+            config.LUT_CACHE = True
+        elif arg.startswith("--color-curve="):
+            from lut_operations import parse_curve
+            config.COLOR_CURVE = parse_curve(arg.split("=", 1)[1])
+        elif arg.startswith("--boost-channel-curve="):
+            from lut_operations import parse_curve
+            config.BOOST_CHANNEL_CURVE = parse_curve(arg.split("=", 1)[1])
         else:
             config.SCENE_DIR = arg
 
@@ -135,82 +312,157 @@ def parse_options():
     config.METADATA_SRC = path.join(config.SCENE_DIR, config.SCENE_NAME + ".xml")
     config.INPUT_FILE = config.NEW_MASK
 
+def select_engine():
+    global img
+
+    if config.ENGINE == "numpy":
+        import array_operations
+        img = array_operations
+    else:
+        import image_operations
+        img = image_operations
+
+def cache_parameters(*names):
+    return dict((name, getattr(config, name)) for name in names)
+
+def tile_files(subdirectory):
+    directory = path.join(config.SCRATCH_PATH, subdirectory)
+    return [path.join(directory, filename)
+            for filename in get_files_by_extension(directory, "png")]
+
+def mask_stage(name, which_lut, which_mask):
+    return cached(
+        name, img.build_mask_files,
+        [config.NEW_MASK], [which_mask],
+        cache_parameters('ENGINE', 'SCRATCH_FORMAT'),
+        config,
+        [which_lut])
+
+def channel_stage(name, function, source):
+    return cached(
+        name, function,
+        [source, config.SNOW_MASK], [path.join(config.SCRATCH_PATH, name + ".png")],
+        cache_parameters('ENGINE', 'SCRATCH_FORMAT', 'COLOR_CURVE', 'BOOST_CHANNEL_CURVE'),
+        config,
+        ["clamp_lut.pgm", "boost_lut.pgm"])
+
 def generate_mask_tiles():
     logger = logging.getLogger(config.SCENE_NAME)
     logger.info(
         "Generating mask tiles of " + str(config.GRID_SIZE) +
         "x" + str(config.GRID_SIZE) + " pixels")
 
+    # virtual tiles live in memory only, so there is nothing to reuse
+    masks = [config.WATER_MASK, config.CLOUD_MASK, config.SNOW_MASK]
+    parameters = cache_parameters('ENGINE', 'GRID_SIZE', 'MASK_BLUR', 'VIRTUAL_TILES')
+
     logger.info("Generating land mask tiles")
-    img.prepare_land_mask(config)
+    with measure("land_mask_tiles", config):
+        prepare = img.prepare_land_mask
+        if not config.VIRTUAL_TILES:
+            prepare = cached("land_mask_tiles", prepare, masks,
+                             lambda: tile_files("land"), parameters, config)
+        prepare(config)
 
     logger.info("Generating cloud mask tiles")
-    img.prepare_cloud_mask(config)
-
-    generated_count = len(get_files_by_extension(path.join(config.SCRATCH_PATH, "land"), "png"))
+    with measure("cloud_mask_tiles", config):
+        prepare = img.prepare_cloud_mask
+        if not config.VIRTUAL_TILES:
+            prepare = cached("cloud_mask_tiles", prepare, masks,
+                             lambda: tile_files("cloud"), parameters, config)
+        prepare(config)
+
+    generated_count = len(img.get_mask_tiles(config))
     logger.info("Generated " + str(generated_count) + " tiles")
 
-def apply_rules(candidates, rejects, subdirectory, rules):
-    accum = []
+def apply_rules(candidates, rejects, subdirectory, rules, statistics):
     logger = logging.getLogger(config.SCENE_NAME)
 
     logger.info("Examining " + str(len(candidates)) + " tiles for " + subdirectory)
-    for filename in candidates:
-        done = False
-        statistics = img.get_image_statistics(path.join(
-            config.SCRATCH_PATH,
-            subdirectory,
-            filename))
-        for rule in rules:
-            if not rule(*statistics):
-                rejects.append(filename)
-                done = True
-                break
-        if done:
-            continue
+    if subdirectory not in statistics:
+        with measure(subdirectory + "_rules", config):
+            statistics[subdirectory] = img.get_tile_statistics(config, subdirectory, candidates)
 
-        accum.append(filename)
+    return filter_tiles(candidates, rejects, statistics[subdirectory], rules)
 
-    return accum
+def save_statistics(filenames, statistics):
+    logger = logging.getLogger(config.SCENE_NAME)
+
+    # tuning needs every tile measured, not just those that reach each rule
+    for subdirectory in ["cloud", "land"]:
+        with measure(subdirectory + "_rules", config):
+            statistics[subdirectory] = img.get_tile_statistics(config, subdirectory, filenames)
+
+    logger.info("Writing tile statistics")
+    write_tile_statistics(
+        path.join("{0}_tiles".format(config.SCENE_NAME), "tile_statistics.csv"),
+        filenames, statistics, config)
+
+def tile_rows(sorted_tiles, config):
+    # rows are built a chunk at a time, a scene never holds all of them
+    for start in range(0, len(sorted_tiles), CSV_CHUNK):
+        for row in build_dicts_for_csv(sorted_tiles[start:start + CSV_CHUNK], config):
+            yield row
+
+def shared_rows(rows, fieldnames):
+    # passes rows on to the scene's manifest, appending them to the combined one
+    # in place of any rows an earlier run of the scene left there
+    replace = ['!scene', config.METADATA['!scene']]
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        yield row
+
+        if len(chunk) == CSV_CHUNK:
+            append_rows(config.COMBINED_MANIFEST, fieldnames, chunk, replace)
+            replace = None
+            chunk = []
+
+    if chunk or replace:
+        append_rows(config.COMBINED_MANIFEST, fieldnames, chunk, replace)
+
+def build_dicts_for_csv(sorted_tiles, config):
+    # sorted_tiles are [filename, reason], projected together in one call
+    # tile sizes follow from the scene size, no tile is opened to measure them
+    tiles = [
+        tile_geometry(filename, config.width, config.height, config.GRID_SIZE)
+        for [filename, reason] in sorted_tiles]
 
-def index_to_location(filename, width, grid_size):
-    per_row = width // grid_size + 1
-    idx = int(filename.split("_")[1].split(".")[0])
-    row = idx // per_row
-    col = idx % per_row
+    accum = []
+    coordinates = compute_tiles_coordinate_metadata(tiles, config)
+    for [filename, reason], [row, column, width, height], coordinate_metadata in zip(
+            sorted_tiles, tiles, coordinates):
+        my_dict = {
+            '#filename': filename,
+            '#reason': reason,
+            '#row': row,
+            '#column': column,
+            '#width': width,
+            '#height': height,
+        }
 
-    return [row, col]
+        my_dict.update(coordinate_metadata)
+        my_dict.update(config.METADATA)
 
-def build_dict_for_csv(filename, reason, config):
-    [width, height] = img.get_dimensions(path.join(config.SCRATCH_PATH, "scene", filename))
-    [row, column] = index_to_location(filename, config.width, config.GRID_SIZE)
+        my_dict['#utm_zone'] = str(abs(int(my_dict['#utm_zone'])))
 
-    my_dict = {
-        '#filename': filename,
-        '#reason': reason,
-        '#row': row,
-        '#column': column,
-        '#width': width,
-        '#height': height,
-    }
+        accum.append(my_dict)
 
-    coordinate_metadata = compute_coordinate_metadata(row, column, width, height, config)
+    return accum
 
-    my_dict.update(coordinate_metadata)
-    my_dict.update(config.METADATA)
-    
-    my_dict['#utm_zone'] = str(abs(int(my_dict['#utm_zone'])))
-    
-    return my_dict
 
+def reset_config():
+    # drops every value set while processing a scene, back to the defaults
+    config.__dict__.clear()
 
-def main():
+def main(args=None):
 
     retained_tiles = []
     no_water = []
     too_cloudy = []
+    statistics = {}
 
-    parse_options()
+    parse_options(argv[1:] if args is None else args)
 
     if  (not config.GENERATE_MASK_TILES and
          not config.REJECT_TILES and
@@ -220,7 +472,7 @@ def main():
          not config.BUILD_MANIFEST and
          not config.REBUILD):
         usage()
-        return
+        return False
 
     if ((config.GENERATE_MASK_TILES or
          config.REJECT_TILES or
@@ -230,14 +482,47 @@ def main():
          config.SLICE_IMAGE) and
             config.SCENE_DIR == ''):
         usage()
-        return
+        return False
 
     logger = logging.getLogger(config.SCENE_NAME)
     logger.setLevel(logging.INFO)
     logger.info("Processing start")
 
+    select_engine()
+    logger.info("Using " + config.ENGINE + " engine")
+
+    if config.VIRTUAL_TILES and config.ENGINE != "numpy":
+        logger.warning("Virtual tiles require the numpy engine, writing mask tiles")
+        config.VIRTUAL_TILES = False
+
+    if config.SCRATCH_FORMAT != "png" and config.ENGINE != "numpy":
+        logger.warning("Only the numpy engine reads npy scratch, writing png")
+        config.SCRATCH_FORMAT = "png"
+
+    if config.STREAM and config.ENGINE != "numpy":
+        logger.warning("Streaming requires the numpy engine, processing whole scene")
+        config.STREAM = False
+    elif config.STREAM:
+        config.VIRTUAL_TILES = True
+
+    if config.RESUME:
+        # the scratch directory outlives a crash and finished stages are skipped
+        config.WITHTEMPDIR = False
+        config.REBUILD = False
+        config.STAGE_CACHE = True
+
+    if config.LEDGER:
+        # stages are only recorded in the ledger while they are cached
+        config.STAGE_CACHE = True
+
+    if config.WRITE_KEPT_ONLY and config.STREAM:
+        logger.warning("Streaming writes every scene tile, ignoring --write-kept-only")
+        config.WRITE_KEPT_ONLY = False
+    elif config.WRITE_KEPT_ONLY and config.SLICE_IMAGE and not config.REJECT_TILES:
+        logger.warning("Only sorting writes kept tiles, slicing every scene tile without --reject")
+        config.WRITE_KEPT_ONLY = False
+
     accepts = []
-    rejects = []
 
     [config.width, config.height] = img.get_dimensions(config.INPUT_FILE)
 
@@ -245,14 +530,30 @@ def main():
         build_scratch(config)
 
     logger.info("Building scene tile output directory")
-    build_output(config.SCENE_NAME)
+    # tiles of an unfinished run may be stale, only a finished scene keeps its own
+    finished = config.RESUME and config.LEDGER and \
+        scene_id(config.SCENE_DIR) in finished_scenes(config.LEDGER)
+    build_output(config.SCENE_NAME, finished)
 
     config.SATELLITE = LANDSAT
-    metadata = parse_metadata(config.SCENE_DIR, config.METADATA_SRC)
+    metadata = parse_metadata(config.SCENE_DIR, config.METADATA_SRC, config.METADATA_INDEX)
     config.METADATA = metadata
     if config.METADATA['spacecraft'] == 'LANDSAT_8':
         config.SATELLITE = LANDSAT8
 
+    if config.TRIAGE:
+        logger.info("Triaging scene")
+        with measure("triage", config):
+            config.TRIAGE_RESULT = triage_scene(config)
+
+        with open(path.join("{0}_tiles".format(config.SCENE_NAME), "triage.json"), 'w') as triage:
+            json.dump(config.TRIAGE_RESULT, triage, indent=2, sort_keys=True)
+
+        if config.TRIAGE_RESULT['skip']:
+            logger.info("Skipping scene, " + config.TRIAGE_RESULT['reason'])
+            maybe_clean_scratch(config)
+            return True
+
     config.RED_CHANNEL = path.join(
         config.SCENE_DIR, config.SCENE_NAME + "_sr_" + config.SATELLITE['red'] + ".tif")
     config.GREEN_CHANNEL = path.join(
@@ -262,77 +563,114 @@ def main():
     config.INFRARED_CHANNEL = path.join(
         config.SCENE_DIR, config.SCENE_NAME + "_sr_" + config.SATELLITE['infrared'] + ".tif")
 
-    logger.info("Building water mask")
     config.WATER_MASK = path.join(config.SCRATCH_PATH, "water_mask.png")
-    img.build_mask_files(config, "water_lut.pgm", config.WATER_MASK)
-    logger.info("Building cloud mask")
     config.CLOUD_MASK = path.join(config.SCRATCH_PATH, "cloud_mask.png")
-    img.build_mask_files(config, "cloud_lut.pgm", config.CLOUD_MASK)
-    logger.info("Building snow mask")
     config.SNOW_MASK = path.join(config.SCRATCH_PATH, "snow_mask.png")
-    img.build_mask_files(config, "snow_lut.pgm", config.SNOW_MASK)
+    stages = [
+        stage("water_mask", mask_stage("water_mask", "water_lut.pgm", config.WATER_MASK),
+              [config, "water_lut.pgm", config.WATER_MASK], [], "Building water mask"),
+        stage("cloud_mask", mask_stage("cloud_mask", "cloud_lut.pgm", config.CLOUD_MASK),
+              [config, "cloud_lut.pgm", config.CLOUD_MASK], [], "Building cloud mask"),
+        stage("snow_mask", mask_stage("snow_mask", "snow_lut.pgm", config.SNOW_MASK),
+              [config, "snow_lut.pgm", config.SNOW_MASK], [], "Building snow mask")
+    ]
     config.INPUT_FILE = config.WATER_MASK
 
-    if config.ASSEMBLE_IMAGE:
+    if config.STREAM:
+        stages = [
+            stage("stream", img.stream_scene, [config], [],
+                  "Processing scene in strips of " + str(config.STRIP_TILES) + " tile rows")
+        ]
+    elif config.ASSEMBLE_IMAGE:
         logger.info("Processing source data to remove negative pixels")
         clamp = img.clamp_image
         boost = img.boost_image
-        clamp(config.RED_CHANNEL, "red", config, False)
-        clamp(config.INFRARED_CHANNEL, "green", config, False)
-        clamp(config.BLUE_CHANNEL, "blue", config, True)
-        boost(config.INFRARED_CHANNEL, config)
+        stages.extend([
+            stage("red", channel_stage("red", clamp, config.RED_CHANNEL),
+                  [config.RED_CHANNEL, "red", config, False], ["snow_mask"]),
+            stage("green", channel_stage("green", clamp, config.INFRARED_CHANNEL),
+                  [config.INFRARED_CHANNEL, "green", config, False], ["snow_mask"]),
+            stage("blue", channel_stage("blue", clamp, config.BLUE_CHANNEL),
+                  [config.BLUE_CHANNEL, "blue", config, True], ["snow_mask"]),
+            stage("boost", channel_stage("boost", boost, config.INFRARED_CHANNEL),
+                  [config.INFRARED_CHANNEL, config], ["snow_mask"])
+        ])
         config.RED_CHANNEL = path.join(config.SCRATCH_PATH, "red.png")
         config.GREEN_CHANNEL = path.join(config.SCRATCH_PATH, "green.png")
         config.BLUE_CHANNEL = path.join(config.SCRATCH_PATH, "blue.png")
         config.INFRARED_CHANNEL = path.join(config.SCRATCH_PATH, "boost.png")
-        img.assemble_image(config)
-    else:
+        stages.append(stage(
+            "assemble",
+            cached(
+                "assemble", img.assemble_image,
+                [config.WATER_MASK, config.RED_CHANNEL, config.GREEN_CHANNEL,
+                 config.BLUE_CHANNEL, config.INFRARED_CHANNEL],
+                [path.join(config.SCRATCH_PATH, name + ".png")
+                 for name in ["water", "land", "masked", "green_final", "render"]],
+                cache_parameters('ENGINE', 'SCRATCH_FORMAT'),
+                config,
+                restore=img.publish_render),
+            [config],
+            ["water_mask", "red", "green", "blue", "boost"]))
+
+    run_stages(stages, config.STAGE_WORKERS, logger, lambda name: measure(name, config))
+
+    if not config.ASSEMBLE_IMAGE:
         logger.info("Skipping scene generation")
 
-    if config.SLICE_IMAGE:
+    if config.SLICE_IMAGE and config.STREAM:
+        logger.info("Scene tiles were written while streaming")
+    elif config.SLICE_IMAGE and config.WRITE_KEPT_ONLY:
+        logger.info("Scene tiles are written once sorted")
+    elif config.SLICE_IMAGE:
         logger.info(
             "Generating scene tiles of " +
             str(config.GRID_SIZE) + "x" +
             str(config.GRID_SIZE)+" pixels")
-        img.prepare_tiles(config)
+        with measure("slice", config):
+            cached(
+                "slice", img.prepare_tiles,
+                [path.join(config.SCRATCH_PATH, "render.png")],
+                lambda: tile_files("scene"),
+                cache_parameters('GRID_SIZE', 'TILE_SIZE', 'PNG_COMPRESSION'),
+                config)(config)
     else:
         logger.info("Skipping scene tile generation")
 
-    if config.GENERATE_MASK_TILES:
+    if config.GENERATE_MASK_TILES and config.STREAM:
+        logger.info("Mask statistics were computed while streaming")
+    elif config.GENERATE_MASK_TILES:
         generate_mask_tiles()
     else:
         logger.info("Skipping mask generation")
 
     if config.REJECT_TILES or config.VISUALIZE_SORT:
 
-        retained_tiles = get_files_by_extension(path.join(config.SCRATCH_PATH, "land"), "png")
+        retained_tiles = img.get_mask_tiles(config)
+
+        if config.SAVE_STATISTICS:
+            save_statistics(retained_tiles, statistics)
 
         if config.REMOVE_CLOUDS:
             retained_tiles = apply_rules(
-                retained_tiles, too_cloudy, "cloud", [
-                    lambda imin, imax, imean, idev: float(imin) < config.CLOUD_THRESHHOLD,
-                    lambda imin, imax, imean, idev: (
-                        float(imean) < config.CLOUD_THRESHHOLD or
-                        float(idev) > config.CLOUD_SENSITIVITY
-                    )
-                ])
+                retained_tiles, too_cloudy, "cloud",
+                cloud_rules(config.CLOUD_THRESHHOLD, config.CLOUD_SENSITIVITY),
+                statistics)
         else:
             logger.info("Skipping cloud removal")
 
         if config.REMOVE_LAND:
             retained_tiles = apply_rules(
-                retained_tiles, no_water, "land", [
-                    lambda imin, imax, imean, idev: float(imax) > config.LAND_THRESHHOLD,
-                    lambda imin, imax, imean, idev: (
-                        float(imean) > config.LAND_THRESHHOLD or
-                        float(idev) > config.LAND_SENSITIVITY
-                    )
-                ])
+                retained_tiles, no_water, "land",
+                land_rules(config.LAND_THRESHHOLD, config.LAND_SENSITIVITY),
+                statistics)
         else:
             logger.info("Skipping land removal")
 
 
-    if config.VISUALIZE_SORT:
+    if config.VISUALIZE_SORT and config.STREAM:
+        logger.info("Skipping tile visualization, streamed scenes have no full mask")
+    elif config.VISUALIZE_SORT:
         logger.info(str(len(retained_tiles))+" tiles retained")
         logger.info(str(len(no_water))+" tiles without water rejected")
         logger.info(str(len(too_cloudy))+" tiles rejected for clouds")
@@ -341,38 +679,63 @@ def main():
         land = img.generate_rectangles(no_water, config.width, config.GRID_SIZE)
         clouds = img.generate_rectangles(too_cloudy, config.width, config.GRID_SIZE)
         water = img.generate_rectangles(retained_tiles, config.width, config.GRID_SIZE)
-        img.draw_visualization(land, clouds, water, config)
+        with measure("visualize", config):
+            img.draw_visualization(land, clouds, water, config)
 
     if config.REJECT_TILES:
-        logger.info("Copying accepted tiles")
-        for filename in retained_tiles:
-            accept_tile(filename, config)
-            accepts.append(build_dict_for_csv(filename, "Accepted", config))
-
-        logger.info("Copying rejected tiles")
-        for filename in no_water:
-            reject_tile(filename, config)
-            rejects.append(build_dict_for_csv(filename, "No Water", config))
-
-        for filename in too_cloudy:
-            reject_tile(filename, config)
-            rejects.append(build_dict_for_csv(filename, "Too Cloudy", config))
-
-        logger.info("Writing csv file")
-        rejects = sorted(rejects, key=lambda k: k['#filename'])
-        write_rejects(
-            path.join("{0}_tiles".format(config.SCENE_NAME), "rejected", "rejected.csv"),
-            rejects)
+        accepts = [[filename, "Accepted"] for filename in sorted(retained_tiles)]
+
+        with measure("csv", config):
+            logger.info("Writing csv file")
+            write_rows(
+                path.join("{0}_tiles".format(config.SCENE_NAME), "rejected", "rejected.csv"),
+                rejects_schema(config.METADATA),
+                tile_rows(sorted(
+                    [[filename, "No Water"] for filename in no_water] +
+                    [[filename, "Too Cloudy"] for filename in too_cloudy]), config))
+
+        with measure("copy", config):
+            if config.WRITE_KEPT_ONLY:
+                logger.info("Writing sorted tiles")
+                img.write_sorted_tiles(config, retained_tiles, no_water + too_cloudy)
+            else:
+                logger.info("Placing accepted tiles")
+                place_tiles(retained_tiles, "accepted", config)
+
+                logger.info("Placing rejected tiles")
+                place_tiles(no_water + too_cloudy, "rejected", config)
 
     if config.BUILD_MANIFEST:
         logger.info("Writing manifest")
-        write_manifest(
-            path.join("{0}_tiles".format(config.SCENE_NAME), "accepted", "manifest.csv"),
-            accepts)
+        with measure("manifest", config):
+            fieldnames = manifest_schema(config.METADATA)
+            rows = tile_rows(accepts, config)
+            if config.COMBINED_MANIFEST:
+                # scenes differ in their optional metadata, the shared file has every key
+                rows = shared_rows(rows, manifest_schema(dict.fromkeys(METADATA_KEYS)))
+            write_rows(
+                path.join("{0}_tiles".format(config.SCENE_NAME), "accepted", "manifest.csv"),
+                fieldnames, rows)
+
+    if config.COLUMNAR_PATH and (config.REJECT_TILES or config.VISUALIZE_SORT):
+        logger.info("Writing columnar tile table")
+        with measure("columnar", config):
+            write_columnar(
+                config.COLUMNAR_PATH,
+                tile_rows(sorted(
+                    [[filename, "Accepted"] for filename in retained_tiles] +
+                    [[filename, "No Water"] for filename in no_water] +
+                    [[filename, "Too Cloudy"] for filename in too_cloudy]), config),
+                statistics, config)
+
+    if config.METRICS:
+        logger.info("Writing stage metrics")
+        write_metrics(path.join("{0}_tiles".format(config.SCENE_NAME), "metrics.json"), config)
 
     maybe_clean_scratch(config)
 
     logger.info("Processing finished")
+    return True
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,74 @@
+from multiprocessing.pool import ThreadPool
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+def stage(name, function, args, after=(), message=None):
+    return {
+        'name': name,
+        'function': function,
+        'args': args,
+        'after': list(after),
+        'message': message
+    }
+
+def _run_stage(item, logger, measure):
+    if item['message']:
+        logger.info(item['message'])
+    if measure is None:
+        item['function'](*item['args'])
+    else:
+        with measure(item['name']):
+            item['function'](*item['args'])
+
+def run_stages(stages, workers, logger, measure=None):
+    names = [item['name'] for item in stages]
+    for item in stages:
+        for dependency in item['after']:
+            if dependency not in names:
+                raise ValueError("Stage {0} depends on unknown stage {1}".format(
+                    item['name'], dependency))
+
+    # stages are listed in a valid order, so one worker just runs them in turn
+    if workers <= 1:
+        for item in stages:
+            _run_stage(item, logger, measure)
+        return
+
+    finished = Queue()
+
+    def run(item):
+        try:
+            _run_stage(item, logger, measure)
+            finished.put([item['name'], None])
+        except Exception as error:
+            finished.put([item['name'], error])
+
+    pool = ThreadPool(workers)
+    try:
+        pending = list(stages)
+        completed = []
+        running = 0
+
+        while pending or running:
+            ready = [item for item in pending
+                     if all(dependency in completed for dependency in item['after'])]
+            for item in ready:
+                pending.remove(item)
+                pool.apply_async(run, [item])
+                running += 1
+
+            if not running:
+                raise ValueError("Stages {0} have circular dependencies".format(
+                    ", ".join(item['name'] for item in pending)))
+
+            [name, error] = finished.get()
+            running -= 1
+            if error is not None:
+                raise error
+            completed.append(name)
+    finally:
+        pool.close()
+        pool.join()
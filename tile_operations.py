@@ -0,0 +1,46 @@
+from __future__ import division
+
+def tile_index(filename):
+    return int(filename.split("_")[1].split(".")[0])
+
+def tile_filename(idx):
+    return "tile_%04d.png" % idx
+
+def tiles_per_row(width, grid_size):
+    # matches the numbering of "-crop", which keeps partial edge tiles
+    return -(-width // grid_size)
+
+def tile_count(width, height, grid_size):
+    return tiles_per_row(width, grid_size) * tiles_per_row(height, grid_size)
+
+def tile_location(idx, width, grid_size):
+    per_row = tiles_per_row(width, grid_size)
+    return [idx // per_row, idx % per_row]
+
+def tile_box(idx, width, height, grid_size):
+    # [left, top, width, height] of a tile, edge tiles are cut short like "-crop"
+    [row, column] = tile_location(idx, width, grid_size)
+    left = column * grid_size
+    top = row * grid_size
+    return [left, top, min(grid_size, width - left), min(grid_size, height - top)]
+
+def tile_geometry(filename, width, height, grid_size):
+    # [row, column, width, height] of a tile from the scene size alone
+    idx = tile_index(filename)
+    return tile_location(idx, width, grid_size) + tile_box(idx, width, height, grid_size)[2:]
+
+def fit_size(width, height, size):
+    # like "-resize SIZExSIZE", the tile grows or shrinks to fit inside the square
+    scale = min(size / width, size / height)
+    return [max(1, int(width * scale + 0.5)), max(1, int(height * scale + 0.5))]
+
+def tile_outputs(config, accepted, rejected):
+    # [tiles, output subdirectory, size] for every group of tiles to write
+    outputs = [[accepted, "accepted", config.TILE_SIZE]]
+
+    if config.REJECTED_TILES == "full":
+        outputs.append([rejected, "rejected", config.TILE_SIZE])
+    elif config.REJECTED_TILES == "thumbnail":
+        outputs.append([rejected, "rejected", config.THUMBNAIL_SIZE])
+
+    return outputs
@@ -0,0 +1,74 @@
+from __future__ import division
+import logging
+
+from rules_operations import rule_settings, sort_tiles
+from tile_operations import tile_count, tile_filename
+
+def metadata_verdict(config):
+    # None when the scene's own cover figures leave it worth a closer look
+    cloud_cover = config.METADATA.get('!cloud_cover')
+    water_cover = config.METADATA.get('!water_cover')
+
+    if cloud_cover and float(cloud_cover) >= config.TRIAGE_MAX_CLOUD_COVER:
+        return "metadata reports {0}% cloud cover".format(cloud_cover)
+    if water_cover and float(water_cover) <= config.TRIAGE_MIN_WATER_COVER:
+        return "metadata reports {0}% water cover".format(water_cover)
+    return None
+
+def decimation(config):
+    # the largest step up to TRIAGE_STEP that divides the grid, so the
+    # decimated tiles line up with, and number like, the real ones
+    for step in range(max(config.TRIAGE_STEP, 1), 0, -1):
+        if config.GRID_SIZE % step == 0:
+            return step
+
+def estimate_tiles(config):
+    import numpy as np
+    from array_operations import (
+        open_band, mask_band, land_source, blur, parse_blur, tile_statistics)
+
+    step = decimation(config)
+    qa = np.ascontiguousarray(open_band(config.NEW_MASK)[::step, ::step])
+
+    water = mask_band(qa, "water_lut.pgm", config)
+    cloud = mask_band(qa, "cloud_lut.pgm", config)
+    snow = mask_band(qa, "snow_lut.pgm", config)
+
+    # the mask blur shrinks with the image, so it spreads over the same ground
+    [radius, sigma] = parse_blur(config.MASK_BLUR)
+    geometry = "{0}x{1}".format(radius / step, sigma / step)
+    statistics = {
+        'land': tile_statistics(blur(land_source(water, cloud, snow), geometry),
+                                config.GRID_SIZE // step),
+        'cloud': tile_statistics(blur(cloud, geometry), config.GRID_SIZE // step)
+    }
+
+    filenames = [
+        tile_filename(idx) for idx in range(tile_count(config.width, config.height, config.GRID_SIZE))]
+    [retained, no_water, too_cloudy] = sort_tiles(
+        filenames, statistics, rule_settings(config), config.REMOVE_CLOUDS, config.REMOVE_LAND)
+
+    return {
+        'tiles': len(filenames),
+        'accepted': len(retained),
+        'no_water': len(no_water),
+        'too_cloudy': len(too_cloudy),
+        'step': step
+    }
+
+def triage_scene(config):
+    logger = logging.getLogger(config.SCENE_NAME)
+
+    reason = metadata_verdict(config)
+    if reason is not None:
+        return {'skip': True, 'reason': reason}
+
+    estimate = estimate_tiles(config)
+    logger.info("Triage estimates {0} of {1} tiles accepted".format(
+        estimate['accepted'], estimate['tiles']))
+
+    if estimate['accepted'] < config.TRIAGE_MIN_TILES:
+        reason = "an estimated {0} tiles would be accepted".format(estimate['accepted'])
+        return {'skip': True, 'reason': reason, 'estimate': estimate}
+
+    return {'skip': False, 'reason': '', 'estimate': estimate}
@@ -0,0 +1,162 @@
+from os import path
+from sys import argv
+from timeit import default_timer
+import itertools
+import logging
+
+from csv_operations import read_tile_statistics, write_tuning
+from rules_operations import SETTINGS, sort_tiles
+from config import config
+
+logging.basicConfig(
+    format='[ff-import %(name)s] %(levelname)s %(asctime)-15s %(message)s'
+)
+
+def usage():
+    print("""
+tune.py (Tile Rule Tuning)
+
+python tune.py [--option] SCENE_tiles [SCENE_tiles ...]
+
+Re-applies the land and cloud rules to the tile statistics that
+simple.py --save-statistics left in each SCENE_tiles directory, for every
+combination of the settings below, without touching any image. Each
+setting takes one value, a comma separated list, or START:STOP:STEP, and
+defaults to the value in config.py.
+
+    --land-threshhold=XX
+    --land-sensitivity=XX
+    --cloud-threshhold=XX
+    --cloud-sensitivity=XX
+
+    --output=MY_FILE        Where to write accept and reject counts for every
+                            scene and combination (default tuning.csv)
+
+    --visualize             Redraw each scene's visualize.png, only with a
+                            single combination and the scene's scratch
+                            directory still in place
+    --scratch-path=MY_PATH  Scratch directory of the scene, or a directory
+                            holding one per scene name
+    --engine=ENGINE         Engine to draw with, as for simple.py
+    """)
+
+def parse_values(value):
+    if ":" in value:
+        [start, stop, step] = [int(number) for number in value.split(":")]
+        return list(range(start, stop + 1, step))
+    return [int(number) for number in value.split(",")]
+
+def scene_name(tiles_dir):
+    tiles_dir = tiles_dir.rstrip("/")
+    if tiles_dir.endswith("_tiles"):
+        return tiles_dir[:-len("_tiles")]
+    return tiles_dir
+
+def redraw(scene, scratch_root, no_water, too_cloudy, retained, grid):
+    if config.ENGINE == "numpy":
+        import array_operations as img
+    else:
+        import image_operations as img
+
+    scratch_path = path.join(scratch_root, path.basename(scene))
+    if not path.isdir(scratch_path):
+        scratch_path = scratch_root
+
+    config.SCENE_NAME = scene
+    config.SCRATCH_PATH = scratch_path
+    config.width = grid['width']
+    config.height = grid['height']
+    config.GRID_SIZE = grid['grid_size']
+    config.INPUT_FILE = path.join(scratch_path, "water_mask.png")
+
+    land = img.generate_rectangles(no_water, grid['width'], grid['grid_size'])
+    clouds = img.generate_rectangles(too_cloudy, grid['width'], grid['grid_size'])
+    water = img.generate_rectangles(retained, grid['width'], grid['grid_size'])
+    img.draw_visualization(land, clouds, water, config)
+
+def main():
+    grid = dict((name, [getattr(config, name)]) for name in SETTINGS)
+    output = "tuning.csv"
+    visualize = False
+    tiles_dirs = []
+
+    for arg in argv[1:]:
+        if arg == "--help" or arg == "-?":
+            usage()
+            return
+        elif arg.startswith("--land-threshhold="):
+            grid['LAND_THRESHHOLD'] = parse_values(arg.split("=")[1])
+        elif arg.startswith("--land-sensitivity="):
+            grid['LAND_SENSITIVITY'] = parse_values(arg.split("=")[1])
+        elif arg.startswith("--cloud-threshhold="):
+            grid['CLOUD_THRESHHOLD'] = parse_values(arg.split("=")[1])
+        elif arg.startswith("--cloud-sensitivity="):
+            grid['CLOUD_SENSITIVITY'] = parse_values(arg.split("=")[1])
+        elif arg.startswith("--output="):
+            output = arg.split("=")[1]
+        elif arg == "--visualize":
+            visualize = True
+        elif arg.startswith("--scratch-path="):
+            config.SCRATCH_PATH = arg.split("=")[1]
+        elif arg.startswith("--engine="):
+            config.ENGINE = arg.split("=")[1]
+        else:
+            tiles_dirs.append(arg)
+
+    if not tiles_dirs:
+        usage()
+        return
+
+    logger = logging.getLogger("tune")
+    logger.setLevel(logging.INFO)
+
+    combinations = [
+        dict(zip(SETTINGS, values))
+        for values in itertools.product(*[grid[name] for name in SETTINGS])]
+
+    if visualize and len(combinations) > 1:
+        logger.warning("Only redrawing visualizations for a single combination")
+        visualize = False
+
+    # redraw points config.SCRATCH_PATH at each scene in turn
+    scratch_root = config.SCRATCH_PATH
+    results = []
+    start = default_timer()
+
+    for tiles_dir in tiles_dirs:
+        scene = scene_name(tiles_dir)
+        [filenames, statistics, scene_grid] = read_tile_statistics(
+            path.join(tiles_dir, "tile_statistics.csv"))
+
+        for settings in combinations:
+            [retained, no_water, too_cloudy] = sort_tiles(filenames, statistics, settings)
+            result = dict((name.lower(), value) for name, value in settings.items())
+            result.update({
+                'scene': scene,
+                'accepted': len(retained),
+                'no_water': len(no_water),
+                'too_cloudy': len(too_cloudy)
+            })
+            results.append(result)
+
+            if visualize:
+                logger.info("Redrawing visualization for " + scene)
+                redraw(scene, scratch_root, no_water, too_cloudy, retained, scene_grid)
+
+    seconds = default_timer() - start
+    logger.info("Evaluated {0} combinations over {1} scenes in {2:.3f}s".format(
+        len(combinations), len(tiles_dirs), seconds))
+
+    for settings in combinations:
+        matching = [result for result in results if all(
+            result[name.lower()] == value for name, value in settings.items())]
+        logger.info("{0}: {1} accepted, {2} no water, {3} too cloudy".format(
+            ", ".join("{0}={1}".format(name.lower(), settings[name]) for name in SETTINGS),
+            sum(result['accepted'] for result in matching),
+            sum(result['no_water'] for result in matching),
+            sum(result['too_cloudy'] for result in matching)))
+
+    write_tuning(output, results)
+
+if __name__ == "__main__":
+    main()
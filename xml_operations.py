@@ -1,54 +1,156 @@
+from os import path, listdir, stat, rename, getpid
+import json
 import logging
+import threading
 from lxml import etree
 
-def get_field_text(tree, path):
-    nsmap = {"espa": tree.getroot().nsmap[None]}
-    node = tree.xpath(path, namespaces=nsmap)
-    if len(node) > 0:
-        return node[0].text
-    return ''
+# element paths below espa_metadata whose text is copied as is
+FIELDS = {
+    ('global_metadata', 'acquisition_date'): 'acquired_date',
+    ('global_metadata', 'scene_center_time'): 'acquired_time',
+    ('global_metadata', 'instrument'): 'sensor_id',
+    ('global_metadata', 'satellite'): 'spacecraft',
+    ('global_metadata', 'earth_sun_distance'): '!earth_sun_distance',
+    ('global_metadata', 'projection_information', 'utm_proj_params', 'zone_code'): '#utm_zone'
+}
 
-def parse_metadata(scene, xml_filename):
+SOLAR_ANGLES = ('global_metadata', 'solar_angles')
+CORNER_POINT = ('global_metadata', 'projection_information', 'corner_point')
+COVER = ('bands', 'band', 'percent_coverage', 'cover')
+
+# every key parse_metadata returns for a complete ESPA scene, some are optional
+METADATA_KEYS = sorted(list(FIELDS.values()) + [
+    '!sun_azimuth', '!sun_zenith', '!cloud_cover', '!water_cover', '!scene',
+    '#scene_corner_UL_x', '#scene_corner_UL_y', '#scene_corner_LR_x', '#scene_corner_LR_y'])
+
+INDEXES = {}
+LOCK = threading.Lock()
+
+def local_name(tag):
+    return tag.split("}")[-1]
+
+def read_metadata(xml_filename):
+    # one streaming pass, every element is dropped as soon as it is read
+    result = dict((key, '') for key in FIELDS.values())
+    stack = []
+    band = None
+    seen_angles = False
+
+    for event, element in etree.iterparse(xml_filename, events=("start", "end")):
+        name = local_name(element.tag)
+
+        if event == "start":
+            stack.append(name)
+            if tuple(stack[1:]) == ('bands', 'band'):
+                band = element.get("name")
+            continue
+
+        key = tuple(stack[1:])
+        stack.pop()
+
+        if key in FIELDS:
+            result[FIELDS[key]] = element.text
+        elif key == SOLAR_ANGLES and not seen_angles:
+            result['!sun_azimuth'] = element.get("azimuth")
+            result['!sun_zenith'] = element.get("zenith")
+            seen_angles = True
+        elif key == CORNER_POINT:
+            result["#scene_corner_{0}_x".format(element.get("location"))] = element.get("x")
+            result["#scene_corner_{0}_y".format(element.get("location"))] = element.get("y")
+        elif key == COVER and band == "cfmask":
+            if element.get("type") == "cloud":
+                result['!cloud_cover'] = element.text
+            if element.get("type") == "water":
+                result['!water_cover'] = element.text
+        elif key == ('bands', 'band') and band == "cfmask":
+            # nothing needed follows the cfmask band
+            break
+
+        if len(stack) <= 2:
+            element.clear()
+
+    return result
+
+def xml_signature(xml_filename):
+    info = stat(xml_filename)
+    return [info.st_size, info.st_mtime]
+
+def load_index(index_file):
+    # workers of a batch look up many scenes, read the file once per change
+    if not path.exists(index_file):
+        return {}
+
+    mtime = stat(index_file).st_mtime
+    with LOCK:
+        if index_file not in INDEXES or INDEXES[index_file][0] != mtime:
+            with open(index_file) as index:
+                INDEXES[index_file] = [mtime, json.load(index)]
+        return INDEXES[index_file][1]
+
+def indexed_metadata(index_file, xml_filename):
+    # None unless the index holds this very file, unchanged since it was read
+    scene_name = path.splitext(path.basename(xml_filename))[0]
+    entry = load_index(index_file).get(scene_name)
+
+    if entry is None or entry['metadata'] is None or \
+            entry['xml'] != path.abspath(xml_filename) or \
+            entry['signature'] != xml_signature(xml_filename):
+        return None
+    return dict(entry['metadata'])
+
+def index_metadata(source_dir, index_file):
+    logger = logging.getLogger("metadata")
+    logger.setLevel(logging.INFO)
+    index = load_index(index_file)
+    updated = {}
+
+    for name in sorted(listdir(source_dir)):
+        scene_dir = path.join(source_dir, name)
+        if not path.isdir(scene_dir):
+            continue
+
+        for filename in listdir(scene_dir):
+            if not filename.endswith(".xml"):
+                continue
+
+            xml_filename = path.abspath(path.join(scene_dir, filename))
+            scene_name = path.splitext(filename)[0]
+            entry = index.get(scene_name)
+
+            if entry is None or entry['xml'] != xml_filename or \
+                    entry['signature'] != xml_signature(xml_filename):
+                logger.info("Indexing metadata of " + scene_name)
+                entry = {
+                    'scene_dir': path.abspath(scene_dir),
+                    'xml': xml_filename,
+                    'signature': xml_signature(xml_filename),
+                    'metadata': None
+                }
+                try:
+                    entry['metadata'] = read_metadata(xml_filename)
+                except etree.XMLSyntaxError as error:
+                    # the scene itself will fail and be reported when processed
+                    logger.warning("Could not index {0}: {1}".format(xml_filename, error))
+
+            updated[scene_name] = entry
+            break
+
+    partial = "{0}.{1}.tmp".format(index_file, getpid())
+    with open(partial, 'w') as index:
+        json.dump(updated, index, indent=2, sort_keys=True)
+    rename(partial, index_file)
+
+    return updated
+
+def parse_metadata(scene, xml_filename, index_file=''):
     logger = logging.getLogger(scene)
-    logger.info("Parsing XML metadata from {0}".format(xml_filename))
-
-    result = {'!scene': scene}
-
-    tree = etree.parse(xml_filename)
-    nsmap = {"espa": tree.getroot().nsmap[None]}
-
-    result['acquired_date'] = get_field_text(tree, "espa:global_metadata/espa:acquisition_date")
-    result['acquired_time'] = get_field_text(tree, "espa:global_metadata/espa:scene_center_time")
-    result['sensor_id'] = get_field_text(tree, "espa:global_metadata/espa:instrument")
-    result['spacecraft'] = get_field_text(tree, 'espa:global_metadata/espa:satellite')
-
-    result['!earth_sun_distance'] = get_field_text(
-        tree,
-        "espa:global_metadata/espa:earth_sun_distance")
-
-    angles = tree.xpath("espa:global_metadata/espa:solar_angles", namespaces=nsmap)
-    if len(angles) > 0:
-        result['!sun_azimuth'] = angles[0].get("azimuth")
-        result['!sun_zenith'] = angles[0].get("zenith")
-
-    covers = tree.xpath(
-        "espa:bands/espa:band[@name='cfmask']/espa:percent_coverage/espa:cover",
-        namespaces=nsmap)
-    for cover in covers:
-        if cover.get("type") == "cloud":
-            result['!cloud_cover'] = cover.text
-        if cover.get("type") == "water":
-            result['!water_cover'] = cover.text
-
-    result['#utm_zone'] = get_field_text(
-        tree,
-        "espa:global_metadata/espa:projection_information/espa:utm_proj_params/espa:zone_code")
-
-    corners = tree.xpath(
-        "espa:global_metadata/espa:projection_information/espa:corner_point",
-        namespaces=nsmap)
-    for corner in corners:
-        result["#scene_corner_{0}_x".format(corner.get("location"))] = corner.get("x")
-        result["#scene_corner_{0}_y".format(corner.get("location"))] = corner.get("y")
 
+    result = indexed_metadata(index_file, xml_filename) if index_file else None
+    if result is None:
+        logger.info("Parsing XML metadata from {0}".format(xml_filename))
+        result = read_metadata(xml_filename)
+    else:
+        logger.info("Using indexed metadata for {0}".format(xml_filename))
+
+    result['!scene'] = scene
     return result